@@ -1,3 +1,4 @@
 from . import ndutils
 from . import segutils
 from . import patchlib
+from . import patchsearch
@@ -6,7 +6,9 @@ Contact: adalca@csail.mit.edu
 """
 
 import builtins
+import functools
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy as sp
@@ -27,22 +29,79 @@ def boundingbox(bwvol):
     -------
     boundingbox : 1-by-(nd*2) array
         [xstart ystart ... xend yend ...]
+
+    See Also
+    --------
+    boundingboxes
     """
 
-    # find indices where bwvol is True
-    idx = np.where(bwvol)
+    bbox = boundingboxes(np.asarray(bwvol, bool)[np.newaxis])[0]
+    if bbox[0] < 0:
+        raise ValueError('boundingbox of an empty volume')
+    return bbox
 
-    # get the starts
-    starts = [np.min(x) for x in idx]
 
-    # get the ends
-    ends = [np.max(x) for x in idx]
+def boundingboxes(vol, labels=None):
+    """
+    bounding box coordinates of a stack of binary masks, or of the labels of a label map
 
-    # concatinate [starts, ends]
-    return np.concatenate((starts, ends), 0)
+    Parameters
+    ----------
+    vol : nd array
+        either a boolean [N, *vol_shape] stack of N masks, processed through per-axis any()
+        projections, or an integer label map, processed in one pass with
+        scipy.ndimage.find_objects
+    labels : optional list
+        for label maps, the labels to compute the bounding boxes of.
+        default: 1 to the largest label in vol
 
+    Returns
+    -------
+    boundingboxes : N-by-(nd*2) array
+        [xstart ystart ... xend yend ...] for each mask or label, -1 for empty ones
 
-def bwdist(bwvol):
+    See Also
+    --------
+    boundingbox
+    """
+
+    if vol.dtype != bool:
+        # label map: bounding box slices of every label
+        assert np.issubdtype(vol.dtype, np.integer), 'label maps should have integer labels'
+        if labels is None:
+            labels = builtins.range(1, max(np.max(vol), 0) + 1)
+        labels = np.asarray(labels, int)
+        max_label = int(max(np.max(labels), 0)) if labels.size > 0 else 0
+        boxes = scipy.ndimage.find_objects(vol, max_label=max_label)
+        bboxes = -np.ones([labels.size, 2 * vol.ndim], int)
+        for i, lab in enumerate(labels):
+            if 0 < lab <= max_label and boxes[lab - 1] is not None:
+                box = boxes[lab - 1]
+                bboxes[i] = [f.start for f in box] + [f.stop - 1 for f in box]
+        return bboxes
+
+    # stack of masks: project each mask onto every axis. The projections onto all but the
+    # last axis are computed from a single reduction over the last axis.
+    nb_dims = vol.ndim - 1
+    nb_masks = vol.shape[0]
+    reduced = np.any(vol, axis=-1) if nb_dims > 1 else None
+    bboxes = -np.ones([nb_masks, 2 * nb_dims], int)
+    for d in builtins.range(nb_dims):
+        if d < nb_dims - 1:
+            axes = tuple(f + 1 for f in builtins.range(nb_dims - 1) if f != d)
+            proj = np.any(reduced, axis=axes) if len(axes) > 0 else reduced
+        else:
+            proj = np.any(vol, axis=tuple(builtins.range(1, nb_dims))) if nb_dims > 1 else vol
+        proj = np.reshape(proj, [nb_masks, -1])
+
+        # first and last non-empty entries of each mask
+        nonempty = np.any(proj, 1)
+        bboxes[nonempty, d] = np.argmax(proj[nonempty], 1)
+        bboxes[nonempty, nb_dims + d] = proj.shape[1] - 1 - np.argmax(proj[nonempty, ::-1], 1)
+    return bboxes
+
+
+def bwdist(bwvol, sampling=None):
     """
     positive distance transform from positive entries in logical image
 
@@ -50,6 +109,8 @@ def bwdist(bwvol):
     ----------
     bwvol : nd array
         The logical volume
+    sampling : optional float or sequence of floats
+        voxel spacing along each dimension. default 1
 
     Returns
     -------
@@ -65,10 +126,10 @@ def bwdist(bwvol):
     revbwvol = np.logical_not(bwvol)
 
     # get distance
-    return scipy.ndimage.morphology.distance_transform_edt(revbwvol)
+    return scipy.ndimage.morphology.distance_transform_edt(revbwvol, sampling=sampling)
 
 
-def bw2sdtrf(bwvol):
+def bw2sdtrf(bwvol, sampling=None, max_distance=None, dtype=None, out=None):
     """
     computes the signed distance transform from the surface between the
     binary True/False elements of logical bwvol
@@ -76,13 +137,24 @@ def bw2sdtrf(bwvol):
     Note: the distance transform on either side of the surface will be +1/-1
     - i.e. there are no voxels for which the dst should be 0.
 
-    Runtime: currently the function uses bwdist twice. If there is a quick way to
-    compute the surface, bwdist could be used only once.
+    Runtime: the negative (inside) transform is only computed within the bounding box of the
+    island(s), padded by one voxel. If max_distance is given, the positive (outside) transform
+    is also only computed within the bounding box padded by max_distance, so that the cost
+    depends on the size of the island(s) rather than the size of the volume.
 
     Parameters
     ----------
     bwvol : nd array
         The logical volume
+    sampling : optional float or sequence of floats
+        voxel spacing along each dimension, for anisotropic volumes. default 1
+    max_distance : optional float
+        distances are only computed up to max_distance (in the units of sampling) from the
+        surface, and clipped to +/- max_distance beyond it. default None (no clipping)
+    dtype : optional numpy dtype
+        output type, e.g. 'float32'. default float64
+    out : optional nd array
+        array (view) of the size of bwvol to write the transform into
 
     Returns
     -------
@@ -94,15 +166,48 @@ def bw2sdtrf(bwvol):
     bwdist
     """
 
-    # get the positive transform (outside the positive island)
-    posdst = bwdist(bwvol)
-
-    # get the negative transform (distance inside the island)
-    notbwvol = np.logical_not(bwvol)
-    negdst = bwdist(notbwvol)
+    bwvol = np.asarray(bwvol, bool)
+    dtype = np.float64 if dtype is None else dtype
+    sdtrf = np.empty(bwvol.shape, dtype) if out is None else out
+    if not np.any(bwvol) or np.all(bwvol):
+        # no surface: every voxel is further than max_distance from it, outside (empty bwvol)
+        # or inside (full bwvol)
+        if max_distance is not None:
+            sdtrf[...] = -max_distance if bwvol.size > 0 and bwvol.flat[0] else max_distance
+            return sdtrf
+
+        # without clipping, combine the (full) positive and negative transforms
+        notbwvol = np.logical_not(bwvol)
+        sdtrf[...] = bwdist(bwvol, sampling) * notbwvol - bwdist(notbwvol, sampling) * bwvol
+        return sdtrf
+
+    # crops around the island(s)
+    nb_dims = bwvol.ndim
+    bbox = boundingbox(bwvol)
+    spacing = np.broadcast_to(1.0 if sampling is None else sampling, [nb_dims])
+
+    def bbox_crop(margin):
+        return tuple(builtins.slice(max(0, s - m), min(v, e + m + 1)) for s, e, m, v in
+                     zip(bbox[:nb_dims], bbox[nb_dims:], margin, bwvol.shape))
+
+    # the positive transform (outside the positive island). Beyond max_distance from the
+    # bounding box, all the voxels are further than max_distance from the island.
+    if max_distance is None:
+        sdtrf[...] = bwdist(bwvol, sampling)
+    else:
+        crop = bbox_crop(np.ceil(max_distance / spacing).astype(int) + 1)
+        sdtrf[...] = max_distance
+        sdtrf[crop] = np.minimum(bwdist(bwvol[crop], sampling), max_distance)
 
-    # combine the positive and negative map
-    return posdst * notbwvol - negdst * bwvol
+    # the negative transform (distance inside the island), exact within the bounding box
+    # padded by one voxel, where every (non-border) side has a False voxel
+    crop = bbox_crop(np.ones(nb_dims, int))
+    inside = bwvol[crop]
+    negdst = bwdist(np.logical_not(inside), sampling)[inside]
+    if max_distance is not None:
+        negdst = np.minimum(negdst, max_distance)
+    sdtrf[crop][inside] = -negdst
+    return sdtrf
 
 
 bw_to_sdtrf = bw2sdtrf
@@ -134,7 +239,7 @@ def bw_grid(vol_shape, spacing, thickness=1):
         rng = [np.arange(0, f) for f in vol_shape]
         for t in range(thickness):
             rng[d] = np.append(np.arange(0 + t, v, spacing[d]), -1)
-            grid_image[tuple(ndgrid(*rng))] = 1
+            grid_image[tuple(ndgrid(*rng, sparse=True))] = 1
 
     return grid_image
 
@@ -197,9 +302,11 @@ def bw_sphere(volshape, rad, loc=None):
         'Location (%d) and volume dimensions (%d) do not match' % (len(loc), len(volshape))
 
     # compute distances between each location in the volume and ``loc``
-    volgrid = volsize2ndgrid(volshape)
-    dst = [np.square(loc[d] - volgrid[d]) for d in range(len(volshape))]
-    dst = np.sqrt(np.sum(dst, 0))
+    volgrid = volsize2ndgrid(volshape, sparse=True)
+    dst = np.zeros(volshape)
+    for d in range(len(volshape)):
+        dst += np.square(loc[d] - volgrid[d])
+    np.sqrt(dst, out=dst)
 
     # draw the sphere
     return dst <= rad
@@ -218,13 +325,16 @@ def ndgrid(*args, **kwargs):
     return np.meshgrid(*args, **kwargs)
 
 
-def volsize2ndgrid(volsize):
+def volsize2ndgrid(volsize, sparse=False):
     """
     return the dense nd-grid for the volume with size volsize
     essentially return the ndgrid fpr
+
+    If sparse is True, return an open grid instead: the d-th entry has size volsize[d] along
+    dimension d and 1 along the others, and broadcasts against the other entries.
     """
     ranges = [np.arange(e) for e in volsize]
-    return ndgrid(*ranges)
+    return ndgrid(*ranges, sparse=sparse)
 
 
 volsize_to_ndgrid = volsize2ndgrid
@@ -437,9 +547,14 @@ def centroid(im):
     """
     compute centroid of a probability ndimage in 0/1
     """
-    volgrid = volsize2ndgrid(im.shape)
-    prob = [np.array(im) * np.array(volgrid[d]) for d in range(len(im.shape))]
-    return [np.sum(p.flat) / np.sum(im) for p in prob]
+    im = np.asarray(im)
+    volgrid = volsize2ndgrid(im.shape, sparse=True)
+    total = np.sum(im)
+
+    # project the image onto each axis, and weigh the projection by the (open) grid
+    nb_dims = len(im.shape)
+    return [np.sum(np.sum(im, tuple(f for f in builtins.range(nb_dims) if f != d),
+                          keepdims=True) * volgrid[d]) / total for d in builtins.range(nb_dims)]
 
 
 def ind2sub_entries(indices, size, **kwargs):
@@ -457,7 +572,7 @@ def ind2sub_entries(indices, size, **kwargs):
     return subvec
 
 
-def gaussian_kernel(sigma, windowsize=None, indexing='ij'):
+def gaussian_kernel(sigma, windowsize=None, indexing='ij', separable=False):
     """
     Create a gaussian kernel nd image
 
@@ -471,9 +586,15 @@ def gaussian_kernel(sigma, windowsize=None, indexing='ij'):
     Parameters:
         sigma: scalar or list of scalars
         windowsize (optional): scalar or list of scalars indicating the shape of the kernel
+        separable (optional, default False): if True, return the normalized 1D kernel of each
+            dimension instead, whose outer product is the ND kernel. These are cached by
+            (sigma, windowsize), and read-only.
 
     Returns:
-        ND kernel the same dimensiosn as the number of sigmas.
+        ND kernel the same dimensiosn as the number of sigmas (or list of 1D kernels).
+
+    See Also:
+        gaussian_smooth
     """
 
     if not isinstance(sigma, (list, tuple)):
@@ -492,28 +613,103 @@ def gaussian_kernel(sigma, windowsize=None, indexing='ij'):
 
     assert indexing == 'ij', 'Only ij indexing implemented so far'
 
+    if separable:
+        return [_gaussian_kernel_1d(float(s), int(w)) for s, w in zip(sigma, windowsize)]
+
     # ok, let's get to work.
     mid = [(w - 1) / 2 for w in windowsize]
 
-    # list of volume ndgrid
-    # N-long list, each entry of shape volshape
-    mesh = volsize2ndgrid(windowsize)
+    # list of volume (open) ndgrid
+    # N-long list, entry f of size windowsize[f] along dimension f
+    mesh = volsize2ndgrid([int(f) for f in windowsize], sparse=True)
 
-    # compute independent gaussians
-    diff = [mesh[f] - mid[f] for f in range(len(windowsize))]
-    exp_term = [- np.square(diff[f]) / (2 * (sigma[f]**2)) for f in range(nb_dims)]
-    norms = [exp_term[f] - np.log(sigma[f] * np.sqrt(2 * np.pi)) for f in range(nb_dims)]
-
-    # add an all-ones entry and transform into a large matrix
-    norms_matrix = np.stack(norms, axis=-1)  # *volshape x N
-    g = np.sum(norms_matrix, -1)  # volshape
-    g = np.exp(g)
+    # compute independent gaussians, and sum their logs into the kernel
+    g = np.zeros([int(f) for f in windowsize])
+    for f in builtins.range(nb_dims):
+        exp_term = - np.square(mesh[f] - mid[f]) / (2 * (sigma[f]**2))
+        g += exp_term - np.log(sigma[f] * np.sqrt(2 * np.pi))
+    np.exp(g, out=g)
     g /= np.sum(g)
 
     return g
 
 
-def perlin_vol(vol_shape, min_scale=0, max_scale=None, interp_order=1, wt_type='monotonic'):
+def gaussian_smooth(vol, sigma, windowsize=None, mode='reflect', cval=0.0, nb_workers=1,
+                    slab_size=None, out=None):
+    """
+    smooth an nd volume with a gaussian kernel, applied as separable 1D kernels axis by axis
+
+    The result is the correlation of vol with gaussian_kernel(sigma, windowsize), at a cost of
+    O(sum(windowsize)) rather than O(prod(windowsize)) per voxel.
+
+    Parameters:
+        vol: nd array
+        sigma: scalar or list of scalars (one per dimension of vol)
+        windowsize (optional): scalar or list of scalars indicating the shape of the kernel.
+            Odd sizes keep the kernel centered. default: see gaussian_kernel
+        mode, cval (optional): how to extend vol beyond its borders, see
+            scipy.ndimage.correlate1d. default: 'reflect'
+        nb_workers (optional, default 1): number of threads smoothing slabs of the volume
+        slab_size (optional): thickness of the slabs (along the first dimension) smoothed
+            separately, each with a halo of half the window. default: the whole volume, or
+            one slab per worker
+        out (optional): array to write the smoothed volume into
+
+    Returns:
+        smoothed volume, float32 if vol is float32 and float64 otherwise
+    """
+
+    nb_dims = vol.ndim
+    if not isinstance(sigma, (list, tuple)):
+        sigma = [sigma] * nb_dims
+    if windowsize is not None and not isinstance(windowsize, (list, tuple)):
+        windowsize = [windowsize] * nb_dims
+    assert len(sigma) == nb_dims, 'sigma and vol should have the same number of dimensions'
+    kernels = gaussian_kernel(list(sigma), windowsize, separable=True)
+
+    dtype = np.float32 if vol.dtype == np.float32 else np.float64
+    if out is None:
+        out = np.empty(vol.shape, dtype)
+
+    def smooth(src):
+        for d, kernel in enumerate(kernels):
+            src = scipy.ndimage.correlate1d(src, kernel, axis=d, output=dtype, mode=mode,
+                                            cval=cval)
+        return src
+
+    if slab_size is None:
+        if nb_workers == 1:
+            out[...] = smooth(vol)
+            return out
+        slab_size = -(-vol.shape[0] // nb_workers)
+
+    # smooth slabs along the first dimension, each with a halo of half the window
+    halo = len(kernels[0]) // 2
+
+    def smooth_slab(start):
+        end = min(start + slab_size, vol.shape[0])
+        if mode in ('wrap', 'grid-wrap'):
+            # the halos of the edge slabs wrap around to the other end of the volume
+            slab = smooth(np.take(vol, builtins.range(start - halo, end + halo), axis=0,
+                                  mode='wrap'))
+            out[start:end] = slab[halo:(halo + end - start)]
+            return
+        src_start, src_end = max(0, start - halo), min(vol.shape[0], end + halo)
+        slab = smooth(vol[src_start:src_end])
+        out[start:end] = slab[(start - src_start):(end - src_start)]
+
+    starts = builtins.range(0, vol.shape[0], slab_size)
+    if nb_workers == 1:
+        for start in starts:
+            smooth_slab(start)
+    else:
+        with ThreadPoolExecutor(nb_workers) as executor:
+            list(executor.map(smooth_slab, starts))
+    return out
+
+
+def perlin_vol(vol_shape, min_scale=0, max_scale=None, interp_order=1, wt_type='monotonic',
+               dtype=np.float64, rand_seed=None, cascade=False):
     """
     generate perlin noise ND volume 
 
@@ -535,47 +731,63 @@ def perlin_vol(vol_shape, min_scale=0, max_scale=None, interp_order=1, wt_type='
     interp_order: interpolation (upscale) order, as used in scipy.ndimage.interpolate.zoom
     wt_type: the weight type between volumes. default: monotonically decreasing with image size.
       options: 'monotonic', 'random'
+    dtype: output (and computation) type, e.g. np.float32 for faster noise. default: np.float64
+    rand_seed: seed (or np.random.Generator) of the random noise. default: None, which uses
+      the global np.random state, as in previous versions.
+    cascade: if True, upsample coarse-to-fine: the noise accumulated so far is upsampled to the
+      next scale only, so that only the last zoom is to the full vol_shape. This is faster, but
+      the interpolation differs slightly from upsampling every scale directly. default: False
 
     https://github.com/adalca/matlib/blob/master/matlib/visual/perlin.m
     loosely inspired from http://nullprogram.com/blog/2007/11/20
+
+    See Also
+    --------
+    perlin_vols
     """
 
-    # input handling
-    assert wt_type in ['monotonic', 'random'], \
-        "wt_type should be in 'monotonic', 'random', got: %s" % wt_type
+    vol = np.zeros(vol_shape, dtype)
+    _perlin_vol(vol, min_scale, max_scale, interp_order, wt_type, rand_seed, cascade)
+    return vol
 
-    if max_scale is None:
-        max_width = np.max(vol_shape)
-        max_scale = np.ceil(np.log2(max_width)).astype('int')
 
-    # decide on scales:
-    scale_shapes = []
-    wts = []
-    for i in range(min_scale, max_scale + 1):
-        scale_shapes.append(np.ceil([f / (2**i) for f in vol_shape]).astype('int'))
+def perlin_vols(nb_vols, vol_shape, min_scale=0, max_scale=None, interp_order=1,
+                wt_type='monotonic', dtype=np.float32, rand_seed=None, cascade=False,
+                nb_workers=1):
+    """
+    generate a batch of perlin noise ND volumes
 
-        # determine weight
-        if wt_type == 'monotonic':
-            wts.append(i + 1)  # larger images (so more high frequencies) get lower weight
-        else:
-            wts.append(np.random.random())
-    wts = np.array(wts) / np.sum(wts)
+    Every volume has its own random stream, spawned from rand_seed (see
+    np.random.SeedSequence.spawn), so that the batch is reproducible for a given rand_seed
+    regardless of nb_workers.
 
-    # get perlin volume
-    vol = np.zeros(vol_shape)
-    for sci, sc in enumerate(scale_shapes):
+    Parameters
+    ----------
+    nb_vols: number of volumes
+    vol_shape, min_scale, max_scale, interp_order, wt_type, cascade: see perlin_vol
+    dtype: output type. default: np.float32
+    rand_seed: seed of the batch. default: None (fresh entropy)
+    nb_workers: number of threads generating volumes. default 1
 
-        # get a small random volume
-        rand_vol = np.random.random(sc)
+    Returns
+    -------
+    [nb_vols, *vol_shape] array of perlin noise volumes
+    """
 
-        # interpolated rand volume to upper side
-        reshape_factor = [vol_shape[d] / sc[d] for d in range(len(vol_shape))]
-        interp_vol = scipy.ndimage.interpolation.zoom(rand_vol, reshape_factor, order=interp_order)
+    vols = np.zeros([nb_vols, *vol_shape], dtype)
+    seeds = np.random.SeedSequence(rand_seed).spawn(nb_vols)
 
-        # add to existing volume
-        vol = vol + wts[sci] * interp_vol
+    def perlin(i):
+        _perlin_vol(vols[i], min_scale, max_scale, interp_order, wt_type,
+                    np.random.default_rng(seeds[i]), cascade)
 
-    return vol
+    if nb_workers == 1:
+        for i in builtins.range(nb_vols):
+            perlin(i)
+    else:
+        with ThreadPoolExecutor(nb_workers) as executor:
+            list(executor.map(perlin, builtins.range(nb_vols)))
+    return vols
 
 
 def sphere_vol(vol_shape, radius, center=None, dtype=bool):
@@ -607,18 +819,20 @@ def sphere_vol(vol_shape, radius, center=None, dtype=bool):
     # check dtype
     assert dtype in [bool, np.float32], 'dtype should be bool, np.float32'
 
-    # prepare mesh
-    mesh = volsize2ndgrid(vol_shape)
-    centered_mesh = [(mesh[f] - center[f])**2 for f in range(ndims)]
-    dist_from_center = np.sqrt(np.sum(np.stack(centered_mesh, ndims), ndims))
+    # prepare (open) mesh, and accumulate the squared distances in place
+    mesh = volsize2ndgrid(vol_shape, sparse=True)
+    dist_from_center = np.zeros(vol_shape)
+    for f in builtins.range(ndims):
+        dist_from_center += (mesh[f] - center[f])**2
+    np.sqrt(dist_from_center, out=dist_from_center)
 
     # create sphere
     sphere = dist_from_center <= radius
     if dtype == np.float32:  # enable partial volume at edge
-        float_sphere = sphere.astype(np.float32)
-        df = radius - dist_from_center
-        edge = np.logical_and(df < 0, df > -1)
-        sphere = float_sphere + edge * (1 + df)
+        # 1 inside, 1 + df on the edge (-1 < df < 0) and 0 outside, with df = radius - dist
+        df = np.subtract(radius + 1, dist_from_center, out=dist_from_center)
+        np.clip(df, 0, 1, out=df)
+        sphere = df.astype(np.float32)
 
     # done!
     return sphere
@@ -628,6 +842,82 @@ def sphere_vol(vol_shape, radius, center=None, dtype=bool):
 # internal
 ###############################################################################
 
+@functools.lru_cache(maxsize=32)
+def _gaussian_kernel_1d(sigma, windowsize):
+    """
+    normalized (read-only) 1D gaussian kernel, see gaussian_kernel
+    """
+
+    mid = (windowsize - 1) / 2
+    kernel = np.exp(- np.square(np.arange(windowsize) - mid) / (2 * (sigma**2)))
+    kernel /= np.sum(kernel)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def _perlin_vol(vol, min_scale, max_scale, interp_order, wt_type, rand_seed, cascade):
+    """
+    accumulate perlin noise into vol, in place. See perlin_vol
+    """
+
+    # input handling
+    assert wt_type in ['monotonic', 'random'], \
+        "wt_type should be in 'monotonic', 'random', got: %s" % wt_type
+    vol_shape = vol.shape
+    rng = np.random if rand_seed is None else np.random.default_rng(rand_seed)
+
+    if max_scale is None:
+        max_width = np.max(vol_shape)
+        max_scale = np.ceil(np.log2(max_width)).astype('int')
+
+    # decide on scales:
+    scale_shapes = []
+    wts = []
+    for i in builtins.range(min_scale, max_scale + 1):
+        scale_shapes.append(np.ceil([f / (2**i) for f in vol_shape]).astype('int'))
+
+        # determine weight
+        if wt_type == 'monotonic':
+            wts.append(i + 1)  # larger images (so more high frequencies) get lower weight
+        else:
+            wts.append(rng.random())
+    wts = np.array(wts) / np.sum(wts)
+
+    if not cascade:
+        # add each (upsampled) scale to the volume, in place
+        interp_vol = np.empty(vol_shape, vol.dtype)
+        for sci, sc in enumerate(scale_shapes):
+
+            # get a small random volume
+            rand_vol = rng.random(sc)
+
+            # interpolated rand volume to upper side
+            reshape_factor = [vol_shape[d] / sc[d] for d in builtins.range(len(vol_shape))]
+            scipy.ndimage.zoom(rand_vol, reshape_factor, output=interp_vol, order=interp_order)
+
+            # add to existing volume
+            interp_vol *= wts[sci]
+            vol += interp_vol
+        return
+
+    # coarse-to-fine: upsample the accumulated noise to the next scale, and add that scale
+    acc = None
+    for sci in builtins.range(len(scale_shapes) - 1, -1, -1):
+        sc = scale_shapes[sci]
+        rand_vol = (wts[sci] * rng.random(sc)).astype(vol.dtype)
+        if acc is not None:
+            reshape_factor = [sc[d] / acc.shape[d] for d in builtins.range(len(vol_shape))]
+            rand_vol += scipy.ndimage.zoom(acc, reshape_factor, output=vol.dtype,
+                                           order=interp_order)
+        acc = rand_vol
+
+    reshape_factor = [vol_shape[d] / acc.shape[d] for d in builtins.range(len(vol_shape))]
+    if np.all(np.array(reshape_factor) == 1):
+        vol += acc
+    else:
+        vol += scipy.ndimage.zoom(acc, reshape_factor, output=vol.dtype, order=interp_order)
+
+
 def _prep_range(*args):
     """
     _prep_range([start], end [,step])
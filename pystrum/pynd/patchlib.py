@@ -6,10 +6,17 @@ Modelled after the MATLAB patchlib (https://github.com/adalca/patchlib)
 """
 
 # built-in
-import sys
+import os
+import mmap
+import json
+import functools
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
 from pprint import pformat
-from random import shuffle
-import random
 
 # third party
 import numpy as np
@@ -23,47 +30,125 @@ def quilt(patches,
           grid_size,
           patch_stride=1,
           nan_func_layers=np.nanmean,
-          nan_func_K=np.nanmean):
+          nan_func_K=np.nanmean,
+          method='stack',
+          batch_size=4096,
+          weights=None,
+          window=None,
+          out=None,
+          slab_size=None,
+          nb_channels=None):
     """
     quilt (merge) or reconstruct volume from patch indexes in library
 
-    TODO: allow patches to be generator
-
     Parameters:
         patches: matrix [N x V x K], with patches(i, :, 1:K)
             indicates K patch candidates at location i (e.g. the result of a 3-nearest
             neightbours search). V = prod(patch_size); N = prod(grid_size)
+            patches can also be a generator (or any iterable) of N patches, each of which
+            has V or V x K entries (e.g. the output of patch_gen). In this case, grid_size
+            must be the grid size (not the target size).
         patch_size: vector indicating the patch size
         grid_size or target_size: vector indicating the grid size in each dimension
             OR
             specification of the target image size instead of the grid_size
         patch_stride (optional, default:1): patch stride (spacing), default is 1 (sliding window)
         nan_func_layers (optional): function to compute accross stack layers. default: np.nanmean
+            See also vote_median, vote_trimmed_mean and vote_majority (for label patches).
         nan_func_K (optional): function to compute accross K (nd+1th dim). default: np.nanmean
+        method (optional, default:'stack'): how to combine overlapping patches.
+            'stack' builds the full [nb_layers x target_size x K] layer stack (see stack()) and
+            applies nan_func_layers to it. 'accumulate' instead keeps running sums and counts
+            the size of the target, so memory is O(target size x K) rather than
+            O(nb_layers x target size x K). 'accumulate' only supports
+            nan_func_layers=np.nanmean.
+        batch_size (optional, default:4096): number of patches processed at once
+        weights (optional): [N] or [N x K] array of non-negative weights for each patch or
+            patch candidate, such as a confidence or a function of the kNN distances
+            (e.g. np.exp(-dst ** 2 / h)). Requires method 'accumulate'.
+        window (optional): [*patch_size] array of non-negative spatial weights applied to every
+            patch, e.g. a gaussian taper such as ndutils.gaussian_kernel(sigma, patch_size).
+            Requires method 'accumulate'.
+            If weights and/or window are given, each voxel is the weighted average of all the
+            patch candidates that overlap it, computed in a single pass, and nan_func_layers and
+            nan_func_K are not used.
+        out (optional): array of size target_size to write the output into, such as an
+            np.memmap opened in 'w+' or 'r+' mode.
+        slab_size (optional): if given, quilt the target slab by slab, each slab_size voxels
+            thick along the first dimension, so that memory is bounded by the slab size, and the
+            patches and out are read and written sequentially (in storage order). This is
+            useful for np.memmap patches and out. See quilt_parallel(). patches needs to be an
+            array (or array-like, such as PCAPatches) rather than a generator.
+        nb_channels (optional): number of channels C of multi-channel patches, given as
+            [N x V x C] or [N x V x K x C] arrays (or as iterables of patches with [*patch_size, C]
+            or V x K x C entries, e.g. from patch_gen on a [*vol_size, C] volume). All the
+            channels are quilted in one pass, sharing the index computations, and the output
+            is [*target_size, C]. default: None (scalar patches)
 
     Returns:
         quilt_img: the quilted nd volume
     """
 
     # input checks
-    assert patches.ndim == 2 or patches.ndim == 3, 'patches should be [NxV] or [NxVxK]'
-    assert patches.shape[1] == np.prod(patch_size), \
-        "patches V (%d) does not match patch size V (%d)" % (patches.shape[1], np.prod(patch_size))
+    assert method in ('stack', 'accumulate'), "method should be 'stack' or 'accumulate'"
+    weighted = weights is not None or window is not None
+    assert not weighted or method == 'accumulate', "weights and window require method 'accumulate'"
+    if hasattr(patches, 'shape'):
+        if nb_channels is None:
+            assert patches.ndim == 2 or patches.ndim == 3, 'patches should be [NxV] or [NxVxK]'
+        else:
+            assert (patches.ndim == 3 or patches.ndim == 4) and patches.shape[-1] == nb_channels,\
+                'patches should be [NxVxC] or [NxVxKxC], with C = nb_channels'
+        assert patches.shape[1] == np.prod(patch_size), \
+            "patches V (%d) does not match patch size V (%d)" % \
+            (patches.shape[1], np.prod(patch_size))
     nb_dims = len(patch_size)
 
-    # stack patches
-    patch_stack = stack(patches, patch_size, grid_size, patch_stride)
+    if slab_size is not None:
+        # quilt one slab at a time, in storage order
+        assert hasattr(patches, 'shape'), 'slab_size needs patches to be an array, not a generator'
+        target_size = _target_size(patches, grid_size, patch_size, patch_stride)
+        nb_slabs = -(-target_size[0] // slab_size)
+        return quilt_parallel(patches, patch_size, grid_size, patch_stride,
+                              nan_func_layers=nan_func_layers, nan_func_K=nan_func_K,
+                              method=method, weights=weights, window=window, nb_workers=1,
+                              nb_tiles=nb_slabs, batch_size=batch_size, out=out,
+                              nb_channels=nb_channels)
+
+    if method == 'stack':
+        # stack patches
+        patch_stack = stack(patches, patch_size, grid_size, patch_stride, batch_size=batch_size,
+                            nb_channels=nb_channels)
+
+        # quilt via nan_funs
+        quilted_vol_k = nan_func_layers(patch_stack, 0)
 
-    # quilt via nan_funs
-    quilted_vol_k = nan_func_layers(patch_stack, 0)
-    quilted_vol = nan_func_K(quilted_vol_k, nb_dims)
-    assert quilted_vol.ndim == len(patch_size), "patchlib: problem with dimensions after quilt"
+    else:
+        assert nan_func_layers is np.nanmean, \
+            "method 'accumulate' only supports nan_func_layers=np.nanmean"
+        target_size = _target_size(patches, grid_size, patch_size, patch_stride)
+        grid_idx = _target_grid(target_size, patch_size, patch_stride)
+        quilted_vol_k = _quilt_accumulate(patches, grid_idx, patch_size, target_size,
+                                          weights=weights, window=window, batch_size=batch_size,
+                                          nb_channels=nb_channels)
+
+    if weighted:
+        # the candidates have already been combined with the overlapping patches
+        quilted_vol = np.take(quilted_vol_k, 0, axis=nb_dims)
+    else:
+        quilted_vol = nan_func_K(quilted_vol_k, nb_dims)
+    assert quilted_vol.ndim == nb_dims + (nb_channels is not None), \
+        "patchlib: problem with dimensions after quilt"
+    if out is not None:
+        out[:] = quilted_vol
+        quilted_vol = out
 
     # done, yey! time to celebrate - maybe visualize the quilted volume?
     return quilted_vol
 
 
-def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1):
+def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1, batch_size=4096,
+          nb_channels=None):
     """
     Stack (gridded) patches in layer structure.
 
@@ -72,18 +157,22 @@ def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1):
     information about the interplay between patch_size, grid_size and patchOverlap, see
     patchlib.grid.
 
-    TODO: allow patches to be generator
-
     Parameters:
         patches: matrix [N x V x K], with patches(i, :, 1:K)
             indicates K patch candidates at location i (e.g. the result of a 3-nearest
             neightbours search). V = prod(patch_size); N = prod(grid_size)
+            patches can also be a generator (or any iterable) of N patches, each of which
+            has V or V x K entries (e.g. the output of patch_gen). In this case, grid_size
+            must be the grid size (not the target size).
         patch_size: vector indicating the patch size
         grid_size or target_size: vector indicating the grid size in each dimension
             OR
             specification of the target image size instead of the grid_size
         patch_stride (optional, default:1): patch stride (spacing), default is 1 (sliding window)
         nargout (optional, default:1): the number of arguments to output
+        batch_size (optional, default:4096): number of patches placed at once
+        nb_channels (optional): number of channels C of multi-channel patches, see quilt(). The
+            layers (and idxmat) then have a trailing C dimension. default: None
 
     Returns:
         layers: a [nb_layers x target_size x K] array, with nb_layers that are the size of
@@ -94,9 +183,9 @@ def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1):
         idxmat (if nargout >= 2): also returns a matrix the same size as
             'layers' containing linear indexes into the inputted patches matrix. This is useful,
             for example, to create a layer structure of patch weights to match the patches
-            layer structure. idxmat is [2 x N x targetSize x K], with idxmat[1, :] giving patch
-            ids, and idxmat[2, :] giving voxel ids
-        p_layer_idx (if nargout == 3): a [V x 1] vector indicating the layer index of each input
+            layer structure. idxmat is [2 x nb_layers x targetSize x K], with idxmat[0, :] giving
+            patch ids, and idxmat[1, :] giving voxel ids
+        p_layer_idx (if nargout == 3): a [N] vector indicating the layer index of each input
             patch
 
     See Also:
@@ -108,90 +197,253 @@ def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1):
     """
 
     #    assert np.all(np.mod(patch_size, 2) == 1), "patch size is not odd"
-    K = patches.shape[2] if len(patches.shape) > 2 else 1
 
     # compute the input target_size and target
-    if np.prod(grid_size) == patches.shape[0]:  # given the number of patches in the grid
-        target_size = grid2volsize(grid_size, patch_size, patch_stride=patch_stride)
-    else:
-        target_size = grid_size
+    target_size = _target_size(patches, grid_size, patch_size, patch_stride)
 
     # compute the grid indexes (and check that the target size matches)
-    [grid_idx, target_size_chk] = grid(target_size, patch_size, patch_stride, nargout=2)
-    assert np.all(target_size == target_size_chk), 'Target does not match the provided target size'
+    grid_idx = _target_grid(target_size, patch_size, patch_stride)
 
-    # prepare subscript and index vectors
+    # prepare subscript vectors
     grid_sub = nd.ind2sub_entries(grid_idx, target_size)
-    all_idx = list(range(grid_idx.size))
+    nb_vox = np.prod(patch_size)
 
     # get index of layer location so that patches don't overlap
     # we do this by computing the modulo of the patch start location
     # with respect to the patch size. This won't be optimal yet, but we'll
     # eliminate any layers with no patches after
-    mod_sub = np.array([_mod_base(g, patch_size) for g in grid_sub]).transpose()
-    patch_payer_idx = nd.sub2ind(mod_sub, patch_size)
+    mod_sub = _mod_base(grid_sub, patch_size).transpose()
+    patch_layer_idx = nd.sub2ind(mod_sub, patch_size)
 
-    # initiate the votes layer structure
-    layer_ids = np.unique(patch_payer_idx)
+    # the layer of each patch, indexing only into non-empty layers
+    layer_ids, patch_layer = np.unique(patch_layer_idx, return_inverse=True)
+    patch_layer = patch_layer.reshape(-1, 1)
     nb_layers = len(layer_ids)
-    layers = np.empty([nb_layers, *target_size, K])
-    layers[:] = np.NAN
-
-    # prepare input matching matrix
-    if nargout >= 2:
-        idxmat = np.empty([2, nb_layers, *target_size, K])
-        idxmat[:] = np.NAN
-
-    #  go over each layer index
-    for layer_idx in range(nb_layers):
-        # get patches attributed to this layer
-        patch_id_in_layer = np.where(patch_payer_idx == layer_ids[layer_idx])
-
-        # prepare the layers
-        layer_stack = np.empty([*target_size, K])
-        layer_stack[:] = np.NAN
-        if nargout >= 2:
-            layer_idxmat = np.nan([2, *target_size, K])
 
-        # go thorugh each patch location for patches in this layer
-        for pidx in patch_id_in_layer[0]:
-
-            # extract the patches
-            localpatches = np.squeeze(patches[pidx, :])
-            patch = np.reshape(localpatches, [*patch_size, K])
-
-            # put the patches in the layers
-            sub = [*grid_sub[pidx, :], 0]
-            endsub = np.array(sub) + np.array([*patch_size, K])
-            rge = nd.slice(sub, endsub)
-            layer_stack[rge] = patch
-
-            # update input matching matrix
+    # put the patches in the layers, a batch at a time. Patches in the same layer don't overlap,
+    # so each (layer, voxel) entry is written at most once
+    layers = None
+    for first, chunk in _patch_chunks(patches, nb_vox, batch_size):
+        last = first + chunk.shape[0]
+        K = chunk.shape[2]
+        if layers is None:
+            layers = np.empty([nb_layers, np.prod(target_size), K])
+            layers[:] = np.nan
             if nargout >= 2:
-                # the linear index of the patch in the grid
-                locidx = np.ones([2, *patch_size, K]) * all_idx[pidx]
-                locidx[1, :] = np.matlib.repmat(list(range(np.prod(patch_size))), 1, K)
-                layer_idxmat[rge] = locidx
+                idxmat = np.empty([2, nb_layers, np.prod(target_size), K])
+                idxmat[:] = np.nan
 
-        # update layer
-        layers[layer_idx, :] = np.reshape(layer_stack.flatten(), [*target_size, K])
+        # linear index of every voxel of every patch in the target [B x V]
+        vox_idx = _patch_vox_idx(grid_idx[first:last], patch_size, target_size)
+        layers[patch_layer[first:last], vox_idx] = chunk
 
-        # update the complete idxmat
+        # update input matching matrix
         if nargout >= 2:
-            idxmat[0, layer_idx, :] = layer_idxmat[0, :]
-            idxmat[1, layer_idx, :] = layer_idxmat[1, :]
+            idxmat[0, patch_layer[first:last], vox_idx] = np.arange(first, last).reshape(-1, 1, 1)
+            idxmat[1, patch_layer[first:last], vox_idx] = np.arange(nb_vox).reshape(1, -1, 1)
+
+    assert layers is not None, 'no patches given'
+    assert last == grid_idx.size, \
+        'number of patches (%d) does not match the grid (%d)' % (last, grid_idx.size)
+    # split the candidates and channels, which were stacked together
+    cand_shape = [K] if nb_channels is None else [K // nb_channels, nb_channels]
+    layers = np.reshape(layers, [nb_layers, *target_size, *cand_shape])
+    if nargout >= 2:
+        idxmat = np.reshape(idxmat, [2, nb_layers, *target_size, *cand_shape])
 
     # setup outputs
     if nargout == 1:
         return layers
     elif nargout == 2:
-        print("idxmat UNTESTED", file=sys.stderr)
         return (layers, idxmat)
     elif nargout == 3:
-        print("p_layer_idx UNTESTED", file=sys.stderr)
-        p = np.zeros(1, np.max(patch_payer_idx.flatten()))
-        p[layer_ids] = list(range(len(layer_ids)))
-        return (layers, idxmat, p[patch_payer_idx])
+        return (layers, idxmat, patch_layer.flatten())
+
+
+def quilt_parallel(patches,
+                   patch_size,
+                   grid_size,
+                   patch_stride=1,
+                   nan_func_layers=np.nanmean,
+                   nan_func_K=np.nanmean,
+                   method='accumulate',
+                   weights=None,
+                   window=None,
+                   nb_workers=None,
+                   backend='process',
+                   nb_tiles=None,
+                   batch_size=4096,
+                   out=None,
+                   nb_channels=None):
+    """
+    quilt (merge) a volume from patches, splitting the work into tiles reduced in parallel
+
+    The target volume is split into slabs along the first dimension. Each tile quilts only the
+    patches that overlap it (a contiguous block of grid rows, including the halo due to patch
+    overlap) and writes its slab of the output. The result is the same as quilt().
+
+    With the 'process' backend, the patches (and weights) are copied once into shared memory
+    that the workers attach to, instead of being pickled, and the workers write their tiles into
+    a shared output buffer. File-backed np.memmap inputs and out are not copied: the workers
+    open the same files.
+
+    Parameters:
+        patches: matrix [N x V] or [N x V x K], see quilt(). Generators are not supported.
+        patch_size: vector indicating the patch size
+        grid_size or target_size: see quilt()
+        patch_stride (optional, default:1): patch stride (spacing)
+        nan_func_layers, nan_func_K, method, weights, window, batch_size, nb_channels
+            (optional): see quilt(). Note that method defaults to 'accumulate' here.
+        nb_workers (optional): number of workers. default: os.cpu_count()
+        backend (optional, default:'process'): 'process' or 'thread'
+        nb_tiles (optional): number of tiles. More tiles balance the load better, but each tile
+            re-reads the patches in its halo. default: nb_workers (capped by the target size)
+        out (optional): array of size target_size to write the output into, such as an
+            np.memmap. Tiles are written in storage order when nb_workers is 1.
+
+    Returns:
+        quilt_img: the quilted nd volume
+
+    See Also:
+        quilt()
+    """
+
+    # input checks
+    assert backend in ('process', 'thread'), "backend should be 'process' or 'thread'"
+    assert hasattr(patches, 'shape'), 'quilt_parallel needs patches to be an array'
+    patch_size = np.array(patch_size, 'int')
+    if isinstance(patch_stride, int):
+        patch_stride = np.repeat(patch_stride, len(patch_size)).astype('int')
+    patch_stride = np.array(patch_stride, 'int')
+    if nb_workers is None:
+        nb_workers = os.cpu_count()
+    if nb_tiles is None:
+        nb_tiles = nb_workers
+
+    # geometry
+    target_size = _target_size(patches, grid_size, patch_size, patch_stride)
+    grid_size = gridsize(target_size, patch_size, patch_stride)
+    assert np.all(grid2volsize(grid_size, patch_size, patch_stride) == target_size), \
+        'Target does not match the provided target size'
+    assert patches.shape[0] == np.prod(grid_size), \
+        'number of patches (%d) does not match the grid (%d)' % \
+        (patches.shape[0], np.prod(grid_size))
+    tiles = _grid_tiles(target_size, grid_size, patch_size, patch_stride, nb_tiles)
+
+    quilt_args = dict(patch_size=patch_size, grid_size=grid_size, patch_stride=patch_stride,
+                      quilt_kwargs=dict(nan_func_layers=nan_func_layers, nan_func_K=nan_func_K,
+                                        method=method, window=window, batch_size=batch_size,
+                                        nb_channels=nb_channels))
+
+    out_size = [*target_size] + ([] if nb_channels is None else [nb_channels])
+    if out is None:
+        out = np.empty(out_size)
+    assert np.all(np.array(out.shape) == out_size), \
+        "out shape %s does not match target size %s" % (pformat(out.shape), pformat(target_size))
+
+    if backend == 'thread' or nb_workers == 1:
+        arrays = dict(patches=patches, weights=weights, out=out)
+        if nb_workers == 1:
+            for tile in tiles:
+                _quilt_tile(tile, arrays=arrays, **quilt_args)
+        else:
+            with ThreadPoolExecutor(nb_workers) as executor:
+                list(executor.map(lambda f: _quilt_tile(f, arrays=arrays, **quilt_args), tiles))
+        return out
+
+    # share the inputs and output with the worker processes
+    owned = []
+    try:
+        specs = {}
+        arrays = dict(patches=patches, weights=weights, out=out)
+        for key, arr in arrays.items():
+            if arr is None:
+                continue
+            if _memmap_spec(arr) is not None:
+                specs[key] = _memmap_spec(arr)
+            else:
+                if key == 'out':
+                    shm, view = _to_shared(None, out.shape, out.dtype)
+                else:
+                    shm, view = _to_shared(np.asarray(arr))
+                owned.append(shm)
+                arrays[key] = view
+                specs[key] = ('shm', shm.name, view.shape, view.dtype)
+
+        with ProcessPoolExecutor(nb_workers, initializer=_attach_shared,
+                                 initargs=(specs, )) as executor:
+            futures = [executor.submit(_quilt_tile, f, **quilt_args) for f in tiles]
+            for future in futures:
+                future.result()
+
+        if arrays['out'] is not out:
+            out[:] = arrays['out']
+        elif isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    finally:
+        for shm in owned:
+            shm.close()
+            shm.unlink()
+
+
+def quilt_sparse(patches,
+                 patch_size,
+                 start_sub,
+                 target_size,
+                 nan_func_K=np.nanmean,
+                 weights=None,
+                 window=None,
+                 batch_size=4096,
+                 out=None,
+                 nb_channels=None):
+    """
+    quilt (merge) a volume from patches at arbitrary (e.g. foreground-only) locations
+
+    Unlike quilt(), the patches don't need to cover a dense grid: only the given patches are
+    accumulated, so the time scales with the number of patches rather than the grid size.
+    Overlapping patches are averaged as in quilt(method='accumulate'), and voxels not covered
+    by any patch are nan.
+
+    Parameters:
+        patches: matrix [N x V] or [N x V x K] of patches (or patch candidates), or a generator
+            of N patches with V or V x K entries. V = prod(patch_size).
+        patch_size: vector indicating the patch size
+        start_sub: [N x nb_dims] starting subscripts of the patches in the target volume
+        target_size: the size of the target volume
+        nan_func_K (optional): function to compute accross K (nd+1th dim). default: np.nanmean
+        weights, window (optional): per-patch weights and spatial window, see quilt()
+        batch_size (optional, default:4096): number of patches processed at once
+        out (optional): array of size target_size to write the output into
+        nb_channels (optional): number of channels C of multi-channel patches, see quilt()
+
+    Returns:
+        quilt_img: the quilted nd volume
+
+    See Also:
+        quilt()
+    """
+
+    # input checks
+    target_size = np.array(target_size, 'int')
+    start_sub = np.reshape(start_sub, [-1, len(patch_size)])
+    assert np.all(start_sub >= 0) and np.all(start_sub + patch_size <= target_size), \
+        'patches need to be inside the target volume'
+    start_idx = nd.sub2ind(start_sub.transpose(), target_size)
+
+    quilted_vol_k = _quilt_accumulate(patches, start_idx, patch_size, target_size,
+                                      weights=weights, window=window, batch_size=batch_size,
+                                      nb_channels=nb_channels)
+    if weights is not None or window is not None:
+        quilted_vol = np.take(quilted_vol_k, 0, axis=len(patch_size))
+    else:
+        quilted_vol = nan_func_K(quilted_vol_k, len(patch_size))
+
+    if out is not None:
+        out[:] = quilted_vol
+        quilted_vol = out
+    return quilted_vol
 
 
 def grid2volsize(grid_size, patch_size, patch_stride=1):
@@ -267,20 +519,9 @@ def gridsize(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1):
     if isinstance(start_sub, int):
         start_sub = np.repeat(start_sub, nb_dims).astype('int')
 
-    # adjacent patch overlap
-    patch_overlap = patch_size - patch_stride
-
-    # modified volume size if starting late
-    mod_vol_size = vol_size - start_sub
-    assert np.all(np.array(mod_vol_size) > 0), "New volume size is non-positive"
-
-    # compute the number of patches
-    # the final volume size will be
-    # >> grid_size * patch_stride + patch_overlap
-    # thus the part that is a multiplier of patch_stride is vol_size - patch_overlap
-    patch_stride_multiples = mod_vol_size - patch_overlap  # not sure?
-    grid_size = np.floor(patch_stride_multiples / patch_stride).astype('int')
-    assert np.all(np.array(grid_size) > 0), "Grid size is non-positive"
+    # cached computation of the grid size
+    grid_size = np.array(_gridsize(*[_geometry_key(f, nb_dims) for f in
+                                     (vol_size, patch_size, patch_stride, start_sub)]))
 
     if nargout == 1:
         return grid_size
@@ -290,7 +531,8 @@ def gridsize(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1):
         return (grid_size, new_vol_size)
 
 
-def grid(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1, grid_type='idx'):
+def grid(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1, grid_type='idx',
+         dtype='int'):
     """
     grid of patch starting points for nd volume that fit into given volume size
 
@@ -312,14 +554,19 @@ def grid(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1, grid_type
             return the idx array only if nargout is 1, or (idx, new_vol_size) if nargout is 2,
             or (idx, new_vol_size, grid_size) if nargout is 3
         grid_type ('idx' or 'sub', optional): how to describe the grid, in linear index (idx)
-            or nd subscripts ('sub'). sub will be a nb_patches x nb_dims ndarray. This is
-            equivalent to sub = ind2sub(vol_size, idx), but is done faster inside this function.
-            [TODO: or it was faster in MATLAB, this might not be true in python anymore]
+            or nd subscripts ('sub'). sub will be a tuple of nb_dims arrays of size grid_size.
+            This is equivalent to sub = ind2sub(vol_size, idx), but is done faster inside this
+            function.
+        dtype (optional, default: 'int'): integer type of the output, e.g. np.int32 to halve
+            memory for volumes with fewer than 2^31 voxels
 
     Returns:
         idx nd array only if nargout is 1, or (idx, new_vol_size) if nargout is 2,
             or (idx, new_vol_size, grid_size) if nargout is 3
 
+        The (read-only) idx or sub arrays are cached for recently requested geometries, up to
+        _GRID_CACHE_BYTES in total, so repeated calls are cheap. Copy them before modifying.
+
     See also:
         gridsize()
 
@@ -339,31 +586,15 @@ def grid(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1, grid_type
     if isinstance(start_sub, int):
         start_sub = np.repeat(start_sub, nb_dims).astype('int')
 
-    # get the grid data
+    # get the grid data, cached for repeated geometries
+    idx = _grid(*[_geometry_key(f, nb_dims) for f in
+                  (vol_size, patch_size, patch_stride, start_sub)],
+                grid_type, np.dtype(dtype).str)
     [grid_size, new_vol_size] = gridsize(vol_size, patch_size,
                                          patch_stride=patch_stride,
                                          start_sub=start_sub,
                                          nargout=2)
 
-    # compute grid linear index
-    # prepare the sample grid in each dimension
-    xvec = ()
-    for idx in range(nb_dims):
-        volend = new_vol_size[idx] + start_sub[idx] - patch_size[idx] + 1
-        locs = list(range(start_sub[idx], volend, patch_stride[idx]))
-        xvec += (locs, )
-        assert any((locs[-1] + patch_size - 1) == (new_vol_size + start_sub - 1))
-
-    # get the nd grid
-    # if want subs, this is the faster way to compute in MATLAB (rather than ind -> ind2sub)
-    # TODO: need to investigate for python, maybe use np.ix_ ?
-    idx = nd.ndgrid(*xvec)
-    if grid_type == 'idx':
-        # if want index, this is the faster way to compute (rather than sub -> sub2ind
-        all_idx = np.array(list(range(0, np.prod(vol_size))))
-        all_idx = np.reshape(all_idx, vol_size)
-        idx = all_idx[idx]
-
     if nargout == 1:
         return idx
     elif nargout == 2:
@@ -377,65 +608,1119 @@ def patch_gen(vol, patch_size, stride=1, nargout=1, rand=False, rand_seed=None):
     generator of patches from volume
 
     Parameters:
-        vol (numpy array): the n-d volume to be patched
+        vol (numpy array): the n-d volume to be patched, optionally with a trailing channel
+            axis, in which case the patches are [*patch_size, C]
         patch_size (numpy vector): the size of the patches
         patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
             default: 1
         nargout (int, optional): how much to yield
             1 (default: the patch) or 2 (tuple with the patch and volume slices for that patch)
-        rand (logical, optional): whether to randomize patch order (default: False)
+            patches are views into vol (see patch_view()), not copies
+        rand (logical, optional): whether to randomize patch order (default: False). The random
+            order is generated lazily, without building the list of all patch locations.
         rand_seed (number, optional): random seed if randomizing patch order
 
     TODO: test more...
-    TODO: use .grid() to get sub
     """
 
     # some parameter checking
     if isinstance(stride, int):
         stride = [stride for f in patch_size]
-    assert len(vol.shape) == len(patch_size), \
+    assert len(vol.shape) in (len(patch_size), len(patch_size) + 1), \
         "vol shape %s and patch size %s do not match dimensions" \
         % (pformat(vol.shape), pformat(patch_size))
-    assert len(vol.shape) == len(stride), \
-        "vol shape %s and patch stride %s do not match dimensions" \
-        % (pformat(vol.shape), pformat(stride))
+    assert len(patch_size) == len(stride), \
+        "patch size %s and patch stride %s do not match dimensions" \
+        % (pformat(patch_size), pformat(stride))
+
+    # view of all the patches, [*grid_size x *patch_size (x C)]
+    patches = patch_view(vol, patch_size, patch_stride=stride)
+    gs = patches.shape[:len(patch_size)]
+
+    # generator
+    for order in _grid_order(gs, rand=rand, rand_seed=rand_seed):
+        for idx in order:
+            sub = np.unravel_index(idx, gs)
+            if nargout == 1:
+                yield patches[sub]
+            else:
+                patch_sub = tuple(slice(f * s, f * s + g)
+                                  for f, s, g in zip(sub, stride, patch_size))
+                yield (patches[sub], patch_sub)
+
+
+def patch_batch_gen(vol, patch_size, batch_size, stride=1, nargout=1, rand=False, rand_seed=None,
+                    reuse_buffer=False, nb_samples=None, replace=False, prob_map=None):
+    """
+    generator of batches of patches from volume
+
+    The patches are visited in the same order as patch_gen() (with the same rand and rand_seed),
+    but are gathered batch_size at a time into a single array.
+
+    Parameters:
+        vol (numpy array): the n-d volume to be patched, optionally with a trailing channel axis
+        patch_size (numpy vector): the size of the patches
+        batch_size (int): the number of patches in each batch. The last batch may be smaller.
+        stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+        nargout (int, optional): how much to yield
+            1 (default: the batch) or 2 (tuple with the batch and [B x nb_dims] patch starting
+            subscripts in vol)
+        rand (logical, optional): whether to randomize patch order (default: False)
+        rand_seed (number, optional): random seed if randomizing patch order
+        reuse_buffer (logical, optional): if True, every batch is written into the same
+            preallocated array, which is only valid until the next batch is requested.
+            default: False
+        nb_samples, replace, prob_map (optional): random sampling options, only used if rand is
+            True. See patch_sampler().
+
+    Yields:
+        [B x *patch_size] (or [B x *patch_size x C]) arrays of patches (and [B x nb_dims]
+            starting subscripts if nargout 2)
+    """
+
+    # view of all the patches, [*grid_size x *patch_size (x C)]
+    if isinstance(stride, int):
+        stride = [stride for f in patch_size]
+    patches = patch_view(vol, patch_size, patch_stride=stride)
+    gs = patches.shape[:len(patch_size)]
+
+    grid_prob = None
+    if prob_map is not None:
+        grid_prob = _grid_prob(prob_map, patch_size, stride, gs)
+    orders = _grid_order(gs, batch_size, rand=rand, rand_seed=rand_seed, nb_samples=nb_samples,
+                         replace=replace, grid_prob=grid_prob)
+
+    buffer = None
+    for order in orders:
+        sub = np.unravel_index(order, gs)
+
+        # gather the batch of patches
+        if reuse_buffer:
+            if buffer is None:
+                buffer = np.empty([batch_size, *patches.shape[len(patch_size):]], vol.dtype)
+            batch = buffer[:len(sub[0])]
+            batch[:] = patches[sub]
+        else:
+            batch = patches[sub]
+
+        if nargout == 1:
+            yield batch
+        else:
+            yield (batch, np.stack(sub, 1) * np.array(stride))
+
+
+def patch_sampler(vol_size, patch_size, patch_stride=1, nb_samples=None, replace=False,
+                  prob_map=None, rand_seed=None, batch_size=4096):
+    """
+    generator of random patch locations on the patch grid, in batches
+
+    Random locations are produced lazily, without materializing the list of all grid
+    locations: sampling without replacement walks a seeded pseudo-random permutation of the
+    grid, and sampling with replacement draws uniform integers. All randomness comes from a
+    local numpy Generator seeded with rand_seed, not from global state.
+
+    Parameters:
+        vol_size (numpy vector): the size of the volume
+        patch_size (numpy vector): the size of the patches
+        patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+        nb_samples (int, optional): the number of locations to sample. default: the number of
+            grid locations (or of grid locations with non-zero probability) if replace is
+            False, required otherwise.
+        replace (logical, optional): whether to sample with replacement. default: False
+        prob_map (nd array, optional): foreground mask or (unnormalized) probability map the
+            size of the volume. A patch is sampled with the probability at its center voxel.
+            Sampling a mask without replacement needs no memory beyond the batch; other
+            probability maps need O(nb grid locations) memory.
+        rand_seed (number, optional): random seed
+        batch_size (int, optional): the number of locations in each batch. default: 4096
+
+    Yields:
+        [B x nb_dims] arrays of patch starting subscripts in the volume
+    """
+
+    # parameter checking
+    nb_dims = len(patch_size)
+    if isinstance(patch_stride, int):
+        patch_stride = [patch_stride] * nb_dims
+    gs = gridsize(vol_size, patch_size, patch_stride=patch_stride)
+
+    grid_prob = None
+    if prob_map is not None:
+        assert np.all(np.array(prob_map.shape) == np.array(vol_size)), \
+            "prob_map shape %s does not match volume size %s" \
+            % (pformat(prob_map.shape), pformat(vol_size))
+        grid_prob = _grid_prob(prob_map, patch_size, patch_stride, gs)
+
+    orders = _grid_order(gs, batch_size, rand=True, rand_seed=rand_seed, nb_samples=nb_samples,
+                         replace=replace, grid_prob=grid_prob)
+    for order in orders:
+        yield np.stack(np.unravel_index(order, gs), 1) * np.array(patch_stride)
+
+
+def patch_view(vol, patch_size, patch_stride=1):
+    """
+    view of all the (gridded) patches of a volume, without copying any data
 
-    cropped_vol_size = np.array(vol.shape) - np.array(patch_size) + 1
-    assert np.all(cropped_vol_size >= 0), \
+    Parameters:
+        vol (numpy array): the n-d volume to be patched, optionally with a trailing channel
+            axis ([*vol_size, C], i.e. one more dimension than patch_size)
+        patch_size (numpy vector): the size of the patches
+        patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+
+    Returns:
+        read-only [*grid_size x *patch_size] (or [*grid_size x *patch_size x C]) strided view
+            into vol, where grid_size = gridsize(vol.shape[:nb_dims], patch_size, patch_stride).
+            e.g. patches[i, j] is the patch starting at vol[i * patch_stride[0],
+            j * patch_stride[1]].
+
+    See Also:
+        patch_matrix(), patch_gen()
+    """
+
+    # parameter checking
+    nb_dims = len(patch_size)
+    if isinstance(patch_stride, int):
+        patch_stride = [patch_stride] * nb_dims
+    assert len(vol.shape) == nb_dims or len(vol.shape) == nb_dims + 1, \
+        "vol shape %s and patch size %s do not match dimensions" \
+        % (pformat(vol.shape), pformat(patch_size))
+    assert len(patch_stride) == nb_dims, \
+        "patch size %s and patch stride %s do not match dimensions" \
+        % (pformat(patch_size), pformat(patch_stride))
+    assert np.all(np.array(vol.shape[:nb_dims]) >= np.array(patch_size)), \
         "patch size needs to be smaller than volume size"
 
-    # get range subs
-    sub = ()
-    for idx, cvs in enumerate(cropped_vol_size):
-        sub += (list(range(0, cvs, stride[idx])), )
+    # all sliding windows, subsampled by the stride
+    windows = np.lib.stride_tricks.sliding_window_view(vol, tuple(patch_size),
+                                                       axis=tuple(range(nb_dims)))
+    windows = windows[tuple(slice(None, None, s) for s in patch_stride)]
+    if len(vol.shape) > nb_dims:
+        # the channel axis goes after the patch axes
+        windows = np.moveaxis(windows, nb_dims, -1)
+    return windows
+
 
-    # check the size
-    gs = gridsize(vol.shape, patch_size, patch_stride=stride)
-    assert [len(f) for f in sub] == list(gs), 'Patch gen side failure'
+def patch_matrix(vol, patch_size, patch_stride=1, out=None, slab_size=None):
+    """
+    extract all the (gridded) patches of a volume into a [N x V] matrix
 
-    # get ndgrid of subs
-    ndg = nd.ndgrid(*sub)
-    ndg = [f.flat for f in ndg]
+    This is the patches layout expected by quilt() and stack(), with N = prod(grid_size) and
+    V = prod(patch_size).
 
-    # generator
-    rng = list(range(len(ndg[0])))
-    if rand:
-        if rand_seed is not None:
-            random.seed(rand_seed)
-        shuffle(rng)
-
-    for idx in rng:
-        slicer = lambda f, g: slice(f[idx], f[idx] + g)
-        patch_sub = [slicer(f, g) for f, g in zip(ndg, patch_size)]
-        # print(patch_sub)
+    Parameters:
+        vol (numpy array): the n-d volume to be patched, optionally with a trailing channel
+            axis, in which case the patches are [N x V x C] (see quilt's nb_channels)
+        patch_size (numpy vector): the size of the patches
+        patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+        out (optional): [N x V (x C)] array to write the patches into, such as an np.memmap
+        slab_size (optional): if given (or if out is given), extract the patches slab by slab,
+            each slab spanning (at least) slab_size voxels along the first dimension, so that
+            vol is read and out is written sequentially. default: one grid row at a time when
+            out is given.
+
+    Returns:
+        contiguous [N x V] array of patches, ordered like grid()
+
+    See Also:
+        patch_view(), quilt()
+    """
+
+    patches = patch_view(vol, patch_size, patch_stride=patch_stride)
+    nb_dims = len(patch_size)
+    row_shape = [np.prod(patch_size), *patches.shape[2 * nb_dims:]]
+    if out is None and slab_size is None:
+        return np.reshape(patches, [-1, *row_shape])
+
+    # extract a block of grid rows at a time
+    stride = patch_stride if isinstance(patch_stride, int) else patch_stride[0]
+    nb_rows = 1 if slab_size is None else max(1, slab_size // stride)
+    nb_row_patches = np.prod(patches.shape[1:nb_dims])
+    out_shape = [patches.shape[0] * nb_row_patches, *row_shape]
+    if out is None:
+        out = np.empty(out_shape, vol.dtype)
+    assert np.all(np.array(out.shape) == out_shape), \
+        "out shape %s does not match the patches" % pformat(out.shape)
+
+    for row in range(0, patches.shape[0], nb_rows):
+        block = patches[row:(row + nb_rows)]
+        first = row * nb_row_patches
+        out[first:(first + np.prod(block.shape[:nb_dims]))] = \
+            np.reshape(block, [-1, *row_shape])
+    return out
+
+
+def patch_matrix_batch(vols, patch_size, patch_stride=1, nb_workers=None, nargout=1, out=None):
+    """
+    extract the (gridded) patches of many volumes into one [N x V] matrix, in parallel
+
+    The volumes (which may have a trailing channel axis, the same for all of them) are spread
+    over a process pool. Each worker writes the patch_matrix() of its
+    volumes directly into the rows of a shared output: a memory-mapped file in shared memory
+    (/dev/shm where available) that is unlinked once all the workers are done, or the given out.
+    The returned memmap stays valid, but since its file is gone, other processes (e.g. the
+    workers of quilt_parallel) receive a copy of it rather than re-opening it.
+
+    Parameters:
+        vols: list of volumes, each an array or the path of a .npy file. Paths are cheaper,
+            since the workers memory-map the files rather than receive a (pickled) copy.
+        patch_size (numpy vector): the size of the patches
+        patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+        nb_workers (int, optional): number of worker processes. default: os.cpu_count()
+        nargout (int, optional): 1 (default) to return the matrix, or 2 to also return the
+            [nb_vols + 1] offsets of each volume's rows in the matrix
+        out (optional): [N x V] array to write the patches into. A file-backed np.memmap is
+            shared with the workers; any other array is filled in this process.
+
+    Returns:
+        [N x V] matrix of the patches of all the volumes (and the row offsets if nargout is 2)
+
+    See Also:
+        patch_matrix(), patch_matrix_stream()
+    """
+
+    # geometry of each volume, computed once per volume shape
+    nb_dims = len(patch_size)
+    shapes, dtypes = zip(*[_vol_info(f) for f in vols])
+    nb_patches = [np.prod(gridsize(f[:nb_dims], patch_size, patch_stride)) for f in shapes]
+    offsets = np.cumsum([0, *nb_patches])
+    row_shape = [np.prod(patch_size), *shapes[0][nb_dims:]]
+    assert all(f[nb_dims:] == shapes[0][nb_dims:] for f in shapes), \
+        'volumes need to have the same number of channels'
+    if nb_workers is None:
+        nb_workers = os.cpu_count()
+
+    filename = None
+    if out is None:
+        # a memory-mapped file in shared memory, so that the workers can write into it
+        tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, filename = tempfile.mkstemp(suffix='.dat', dir=tmp_dir)
+        os.close(fd)
+        out = np.memmap(filename, np.result_type(*dtypes), 'w+',
+                        shape=(offsets[-1], *row_shape))
+    assert np.all(np.array(out.shape) == [offsets[-1], *row_shape]), \
+        "out shape %s does not match the patches" % pformat(out.shape)
+
+    try:
+        tasks = [(vol, patch_size, patch_stride, first) for vol, first in zip(vols, offsets)]
+        if nb_workers == 1 or _memmap_spec(out) is None:
+            for task in tasks:
+                _extract_patches(*task, out=out)
+        else:
+            with ProcessPoolExecutor(nb_workers, initializer=_attach_shared,
+                                     initargs=(dict(out=_memmap_spec(out)), )) as executor:
+                list(executor.map(_extract_patches, *zip(*tasks)))
+            if isinstance(out, np.memmap):
+                out.flush()
+
+    finally:
+        if filename is not None:
+            os.remove(filename)  # the mapping stays valid until out is released
+
+    if nargout == 1:
+        return out
+    else:
+        return (out, offsets)
+
+
+def patch_matrix_stream(vols, patch_size, patch_stride=1, nb_workers=None):
+    """
+    generator of the [N_i x V] patch matrix of each of many volumes, extracted in parallel
+
+    Parameters:
+        vols: list of volumes, each an array or the path of a .npy file
+        patch_size (numpy vector): the size of the patches
+        patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+            default: 1
+        nb_workers (int, optional): number of worker processes. default: os.cpu_count()
+
+    Yields:
+        (vol_idx, patches) tuples, in the order of vols
+
+    See Also:
+        patch_matrix(), patch_matrix_batch()
+    """
+
+    if nb_workers is None:
+        nb_workers = os.cpu_count()
+    tasks = [(vol, patch_size, patch_stride) for vol in vols]
+
+    if nb_workers == 1:
+        for vol_idx, task in enumerate(tasks):
+            yield (vol_idx, _extract_patches(*task))
+        return
+
+    # keep at most max_pending volumes in flight, so that finished blocks don't pile up when
+    # the consumer is slower than the workers
+    max_pending = 2 * nb_workers
+    with ProcessPoolExecutor(nb_workers) as executor:
+        pending = deque()
+        for vol_idx, task in enumerate(tasks):
+            pending.append(executor.submit(_extract_patches, *task))
+            if len(pending) >= max_pending:
+                yield (vol_idx - len(pending) + 1, pending.popleft().result())
+        while pending:
+            yield (len(tasks) - len(pending), pending.popleft().result())
+
+
+def patch_pca(patches, rank, nb_samples=None, rand_seed=None):
+    """
+    principal components of a set of patches, fitted on a random subsample
+
+    Parameters:
+        patches: [N x V] matrix of patches
+        rank (int): number of components to keep
+        nb_samples (int, optional): number of (random) patches used to fit the components.
+            default: all of them
+        rand_seed (number, optional): random seed for the subsample
+
+    Returns:
+        (mean, basis): [V] mean patch and [rank x V] basis with orthonormal rows, such that
+            codes = (patches - mean) @ basis.T and patches ~= codes @ basis + mean
+    """
+
+    nb_patches = patches.shape[0]
+    if nb_samples is not None and nb_samples < nb_patches:
+        rng = np.random.default_rng(rand_seed)
+        patches = patches[np.sort(rng.choice(nb_patches, nb_samples, replace=False))]
+    patches = np.reshape(patches, [patches.shape[0], -1]).astype(float)
+    assert rank <= min(patches.shape), \
+        'rank (%d) is larger than the number of samples or patch size %s' % \
+        (rank, pformat(patches.shape))
+
+    mean = np.mean(patches, 0)
+    _, _, basis = np.linalg.svd(patches - mean, full_matrices=False)
+    return (mean, basis[:rank])
+
+
+def pca_compress(patches, rank, nb_samples=10000, rand_seed=None, dtype='float32',
+                 batch_size=4096):
+    """
+    compress patches into low-rank PCA codes over a shared basis
+
+    The basis is fitted (see patch_pca) on a random subsample of the patches (all K candidates
+    of each sampled patch are used as samples), and the patches are then encoded a batch at a
+    time, so that patches can be an np.memmap. Storage goes from N x V x K to N x rank x K
+    values (plus the basis).
+
+    Parameters:
+        patches: [N x V] or [N x V x K] array of (non-nan) patches
+        rank (int): number of components to keep
+        nb_samples (int, optional): number of patches used to fit the basis. default: 10000
+        rand_seed (number, optional): random seed for the subsample
+        dtype (optional): type of the codes. default: 'float32'
+        batch_size (optional, default:4096): number of patches encoded at once
+
+    Returns:
+        PCAPatches container, which can be passed to quilt() and stack() in place of patches,
+            and which reports its reconstruction error (rmse and rel_error)
+
+    See Also:
+        patch_pca(), PCAPatches
+    """
+
+    assert patches.ndim == 2 or patches.ndim == 3, 'patches should be [NxV] or [NxVxK]'
+    nb_patches, nb_vox = patches.shape[:2]
+
+    # fit the basis on a subsample, using every candidate as a sample
+    idx = np.arange(nb_patches)
+    if nb_samples is not None and nb_samples < nb_patches:
+        rng = np.random.default_rng(rand_seed)
+        idx = np.sort(rng.choice(nb_patches, nb_samples, replace=False))
+    samples = np.reshape(patches[idx], [idx.size, nb_vox, -1])
+    samples = np.reshape(np.moveaxis(samples, 2, 1), [-1, nb_vox])
+    mean, basis = patch_pca(samples, min(rank, *samples.shape))
+
+    # encode, tracking the (exact) reconstruction error: since the basis is orthonormal, the
+    # residual energy of a patch is its centered energy minus that of its code
+    codes = None
+    residual, energy = 0, 0
+    for first, chunk in _patch_chunks(patches, nb_vox, batch_size):
+        if codes is None:
+            codes = np.empty([nb_patches, basis.shape[0], chunk.shape[2]], dtype)
+        centered = chunk - mean[:, np.newaxis]
+        chunk_codes = np.matmul(basis, centered)
+        codes[first:(first + chunk.shape[0])] = chunk_codes
+        residual += np.sum(centered ** 2) - np.sum(chunk_codes ** 2)
+        energy += np.sum(np.square(chunk, dtype=float))
+
+    residual = max(residual, 0)
+    rmse = np.sqrt(residual / (nb_patches * nb_vox * codes.shape[2]))
+    rel_error = np.sqrt(residual / energy) if energy > 0 else 0.0
+    return PCAPatches(codes, mean, basis, squeeze=patches.ndim == 2,
+                      error=dict(rmse=rmse, rel_error=rel_error))
+
+
+def vote_median(layers, axis=0):
+    """
+    median of the (non-nan) votes along an axis, e.g. of the layer stack in quilt()
+
+    Faster drop-in for np.nanmedian as quilt's nan_func_layers or nan_func_K: voxels are grouped
+    by their number of valid votes, and each group's median is found with np.partition.
+
+    Parameters:
+        layers: nd array of votes, with nan where there is no vote
+        axis (optional, default:0): axis of the votes
+
+    Returns:
+        array with axis removed, nan where there are no votes
+    """
+
+    def median(votes, nb_votes):
+        lo, hi = (nb_votes - 1) // 2, nb_votes // 2
+        votes = np.partition(votes, [lo, hi], axis=1)
+        return (votes[:, lo] + votes[:, hi]) / 2
+
+    return _reduce_votes(layers, axis, median)
+
+
+def vote_trimmed_mean(layers, axis=0, trim=0.1):
+    """
+    trimmed mean of the (non-nan) votes along an axis, e.g. of the layer stack in quilt()
+
+    The lowest and highest floor(trim * nb_votes) votes of each voxel are discarded (keeping at
+    least one vote) before averaging. Use e.g. functools.partial(vote_trimmed_mean, trim=0.2)
+    to change trim when passing it to quilt().
+
+    Parameters:
+        layers: nd array of votes, with nan where there is no vote
+        axis (optional, default:0): axis of the votes
+        trim (optional, default:0.1): fraction of votes to discard at each end
+
+    Returns:
+        array with axis removed, nan where there are no votes
+    """
+
+    assert 0 <= trim < 0.5, 'trim should be in [0, 0.5)'
+
+    def trimmed_mean(votes, nb_votes):
+        cut = min(int(np.floor(trim * nb_votes)), (nb_votes - 1) // 2)
+        votes = np.partition(votes, [cut, nb_votes - cut - 1], axis=1)
+        return np.mean(votes[:, cut:(nb_votes - cut)], 1)
+
+    return _reduce_votes(layers, axis, trimmed_mean)
+
+
+def vote_majority(layers, axis=0, block_size=2 ** 22):
+    """
+    most frequent (non-nan) vote along an axis, e.g. for quilting label patches
+
+    Votes are counted per voxel and label with np.bincount rather than treated as floats. Ties
+    go to the smallest label.
+
+    Parameters:
+        layers: nd array of label votes, with nan where there is no vote
+        axis (optional, default:0): axis of the votes
+        block_size (optional): number of (voxel, label) counts held in memory at once
+
+    Returns:
+        array with axis removed, nan where there are no votes
+    """
+
+    votes = np.moveaxis(layers, axis, -1)
+    out_shape = votes.shape[:-1]
+    votes = np.reshape(votes, [-1, votes.shape[-1]])
+    valid = np.logical_not(np.isnan(votes))
+    labels = np.unique(votes[valid])
+    nb_labels = max(len(labels), 1)
+
+    out = np.full(votes.shape[0], np.nan)
+    nb_rows = max(1, block_size // nb_labels)
+    for first in range(0, votes.shape[0], nb_rows):
+        block = slice(first, first + nb_rows)
+        rows, cols = np.nonzero(valid[block])
+        lab = np.searchsorted(labels, votes[block][rows, cols])
+        nb_block_rows = valid[block].shape[0]
+        counts = np.bincount(rows * nb_labels + lab, minlength=nb_block_rows * nb_labels)
+        counts = np.reshape(counts, [nb_block_rows, nb_labels])
+        voted = np.any(valid[block], 1)
+        out[block][voted] = labels[np.argmax(counts[voted], 1)]
+
+    return np.reshape(out, out_shape)
+
+
+class PatchStoreWriter(object):
+    """
+    writer of a chunked, on-disk patch dataset, read with PatchStore
+
+    The store is a directory holding the patches in fixed-size chunks, each a .npy file (which
+    can be memory-mapped) or, if compressed, a .npz file, along with an index table giving the
+    source volume and starting subscript of every patch, and a json header.
+
+    use:
+        with PatchStoreWriter(path, patch_size) as writer:
+            for vol_id, vol in enumerate(vols):
+                writer.add_volume(vol, patch_size, stride=2, volume_id=vol_id)
+    """
+
+    def __init__(self, path, patch_shape=None, dtype='float32', chunk_size=4096, compress=False,
+                 mode='w', nb_dims=None):
+        """
+        Parameters:
+            path: directory of the store
+            patch_shape: the shape of each patch (e.g. the patch size, followed by the number
+                of channels for multi-channel patches). Not needed in mode 'a'.
+            dtype (optional, default:'float32'): the data type the patches are stored as
+            chunk_size (int, optional): number of patches per chunk. default: 4096
+            compress (logical, optional): whether to compress the chunks. Compressed chunks
+                can't be memory-mapped, and are decompressed whole when read. default: False
+            mode (optional, default:'w'): 'w' to create a new store (erasing any existing one),
+                or 'a' to append to an existing store
+            nb_dims (int, optional): number of (spatial) dimensions of the patch starting
+                subscripts. default: the length of the patch_size of the first add_volume(),
+                or of the start_sub or patch_shape of the first add(). Not needed in mode 'a'.
+        """
+
+        assert mode in ('w', 'a'), "mode should be 'w' or 'a'"
+        self.path = path
+        self._chunk = []
+
+        if mode == 'a' and os.path.isfile(os.path.join(path, _STORE_HEADER)):
+            # continue the existing store, reloading its last (partial) chunk
+            store = PatchStore(path)
+            self.meta = store.meta
+            self.meta.setdefault('nb_dims', store.index.dtype['start'].shape[0])
+            self._index = [store.index]
+            nb_full_chunks = len(store) // self.meta['chunk_size']
+            if len(store) > nb_full_chunks * self.meta['chunk_size']:
+                self._chunk = [np.array(store._load_chunk(nb_full_chunks))]
+            self._nb_written = nb_full_chunks * self.meta['chunk_size']
+
+        else:
+            assert patch_shape is not None, 'patch_shape is needed to create a new store'
+            if os.path.isdir(path):
+                for f in os.listdir(path):
+                    if f == _STORE_HEADER or f == _STORE_INDEX or f.startswith('chunk_'):
+                        os.remove(os.path.join(path, f))
+            os.makedirs(path, exist_ok=True)
+            self.meta = dict(version=1, patch_shape=[int(f) for f in patch_shape],
+                             dtype=np.dtype(dtype).str, chunk_size=int(chunk_size),
+                             compress=bool(compress), nb_patches=0,
+                             nb_dims=None if nb_dims is None else int(nb_dims))
+            self._index = []
+            self._nb_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, patches, volume_id=0, start_sub=None):
+        """
+        add patches to the store
+
+        Parameters:
+            patches: [B x *patch_shape] array of patches
+            volume_id (int or [B] vector, optional): source volume of the patches. default: 0
+            start_sub ([B x nb_dims], optional): starting subscripts of the patches in their
+                volume. default: -1
+        """
+
+        patches = np.reshape(patches, [-1, *self.meta['patch_shape']])
+        if self.meta['nb_dims'] is None:
+            self.meta['nb_dims'] = len(self.meta['patch_shape']) if start_sub is None \
+                else int(np.shape(start_sub)[-1])
+        index = _store_index(patches.shape[0], self.meta['nb_dims'])
+        index['volume'] = volume_id
+        index['start'] = -1 if start_sub is None else start_sub
+        self._index.append(index)
+
+        # write the full chunks
+        self._chunk.append(patches.astype(self.meta['dtype'], copy=False))
+        nb_pending = sum(f.shape[0] for f in self._chunk)
+        chunk_size = self.meta['chunk_size']
+        if nb_pending >= chunk_size:
+            pending = np.concatenate(self._chunk, 0)
+            nb_full = (nb_pending // chunk_size) * chunk_size
+            for first in range(0, nb_full, chunk_size):
+                self._write_chunk(pending[first:(first + chunk_size)])
+            self._chunk = [pending[nb_full:]]
+
+    def add_volume(self, vol, patch_size, stride=1, volume_id=0, batch_size=4096):
+        """
+        add all the (gridded) patches of a volume to the store, see patch_batch_gen()
+        """
+
+        if self.meta['nb_dims'] is None:
+            self.meta['nb_dims'] = len(patch_size)
+        assert self.meta['nb_dims'] == len(patch_size), \
+            'patch_size should have %d dimensions, like the store' % self.meta['nb_dims']
+        for batch, sub in patch_batch_gen(vol, patch_size, batch_size, stride=stride, nargout=2):
+            self.add(batch, volume_id=volume_id, start_sub=sub)
+
+    def close(self):
+        """
+        write the last (partial) chunk, the index table and the header
+        """
+
+        pending = [f for f in self._chunk if f.shape[0] > 0]
+        if len(pending) > 0:
+            self._write_chunk(np.concatenate(pending, 0))
+        self._chunk = []
+
+        if self.meta['nb_dims'] is None:
+            self.meta['nb_dims'] = len(self.meta['patch_shape'])
+        index = np.concatenate(self._index) if len(self._index) > 0 else \
+            _store_index(0, self.meta['nb_dims'])
+        self._index = [index]
+        np.save(os.path.join(self.path, _STORE_INDEX), index)
+
+        self.meta['nb_patches'] = int(index.shape[0])
+        with open(os.path.join(self.path, _STORE_HEADER), 'w') as f:
+            json.dump(self.meta, f)
+
+    def _write_chunk(self, chunk):
+        chunk_id = self._nb_written // self.meta['chunk_size']
+        filename = os.path.join(self.path, _store_chunk_file(chunk_id, self.meta['compress']))
+        if self.meta['compress']:
+            np.savez_compressed(filename, patches=chunk)
+        else:
+            np.save(filename, chunk)
+        self._nb_written += chunk.shape[0]
+
+
+class PatchStore(object):
+    """
+    reader of a chunked, on-disk patch dataset written with PatchStoreWriter
+
+    Supports len(), O(1) random access with store[i], slices and index arrays (returning
+    [B x *patch_shape] arrays), and streaming through batches(). Uncompressed chunks are
+    memory-mapped, and compressed chunks are decompressed on demand, keeping the most recently
+    used ones in memory.
+    """
+
+    def __init__(self, path, cache_size=8):
+        """
+        Parameters:
+            path: directory of the store
+            cache_size (int, optional): number of (decompressed) chunks to keep in memory.
+                default: 8
+        """
+
+        self.path = path
+        with open(os.path.join(path, _STORE_HEADER), 'r') as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(path, _STORE_INDEX))
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.meta['nb_patches']
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            assert 0 <= idx < len(self), 'index %d out of range' % idx
+            chunk_id, offset = divmod(idx, self.meta['chunk_size'])
+            return self._load_chunk(chunk_id)[offset]
+
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+
+        # gather the patches, one chunk at a time
+        patches = np.empty([idx.size, *self.meta['patch_shape']], self.meta['dtype'])
+        chunk_ids, offsets = np.divmod(idx.ravel(), self.meta['chunk_size'])
+        for chunk_id in np.unique(chunk_ids):
+            sel = chunk_ids == chunk_id
+            patches[sel] = self._load_chunk(chunk_id)[offsets[sel]]
+        return np.reshape(patches, [*idx.shape, *self.meta['patch_shape']])
+
+    def batches(self, batch_size, shuffle=False, rand_seed=None, shuffle_chunks=4, nargout=1):
+        """
+        stream the patches in batches
+
+        Parameters:
+            batch_size (int): number of patches per batch (the last batch may be smaller)
+            shuffle (logical, optional): whether to shuffle the patches. Chunks are visited in a
+                random order, and patches are shuffled within groups of shuffle_chunks chunks,
+                so that every chunk is read (or decompressed) only once. default: False
+            rand_seed (number, optional): random seed if shuffling
+            shuffle_chunks (int, optional): number of chunks shuffled together. default: 4
+            nargout (int, optional): 1 (default) to yield the patches, or 2 to yield (patches,
+                index entries)
+
+        Yields:
+            [B x *patch_shape] arrays of patches (and [B] index entries if nargout is 2)
+        """
+
+        chunk_size = self.meta['chunk_size']
+        nb_chunks = -(-len(self) // chunk_size)
+        rng = np.random.default_rng(rand_seed)
+        chunk_order = rng.permutation(nb_chunks) if shuffle else np.arange(nb_chunks)
+        group_size = shuffle_chunks if shuffle else 1
+
+        pending = np.zeros(0, 'int')
+        for first in range(0, nb_chunks, group_size):
+            group = chunk_order[first:(first + group_size)]
+            idx = np.concatenate([np.arange(f * chunk_size, min((f + 1) * chunk_size, len(self)))
+                                  for f in group])
+            if shuffle:
+                idx = rng.permutation(idx)
+            pending = np.concatenate([pending, idx])
+
+            while pending.size >= batch_size:
+                yield self._batch(pending[:batch_size], nargout)
+                pending = pending[batch_size:]
+
+        if pending.size > 0:
+            yield self._batch(pending, nargout)
+
+    def _batch(self, idx, nargout):
         if nargout == 1:
-            yield vol[patch_sub]
+            return self[idx]
+        return (self[idx], self.index[idx])
+
+    def _load_chunk(self, chunk_id):
+        """
+        the [chunk_size x *patch_shape] patches of a chunk (memory-mapped if not compressed)
+        """
+
+        if chunk_id in self._cache:
+            self._cache.move_to_end(chunk_id)
+            return self._cache[chunk_id]
+
+        filename = os.path.join(self.path, _store_chunk_file(chunk_id, self.meta['compress']))
+        if self.meta['compress']:
+            with np.load(filename) as data:
+                chunk = data['patches']
         else:
-            yield (vol[patch_sub], patch_sub)
+            chunk = np.load(filename, mmap_mode='r')
+
+        self._cache[chunk_id] = chunk
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return chunk
+
+
+class PCAPatches(object):
+    """
+    patches stored as low-rank PCA codes over a shared basis, see pca_compress()
+
+    Behaves like the (read-only) [N x V] or [N x V x K] patch matrix in quilt() and stack():
+    it has a shape, and np.asarray() decodes it. Slicing (or indexing with an array) returns
+    another PCAPatches over the selected codes, and an integer returns a decoded patch. quilt()
+    and stack() read their patches a batch at a time, so each batch is decoded just before it is
+    accumulated, and the dense patch matrix is never built.
+
+    Attributes:
+        codes: [N x rank x K] codes
+        mean: [V] mean patch
+        basis: [rank x V] orthonormal basis
+        rmse, rel_error: root mean squared reconstruction error of the compressed patches, and
+            the reconstruction error relative to their norm
+    """
+
+    def __init__(self, codes, mean, basis, squeeze=False, error=None):
+        """
+        Parameters:
+            codes: [N x rank x K] codes
+            mean: [V] mean patch
+            basis: [rank x V] basis
+            squeeze (logical, optional): whether the patches are [N x V] (K = 1). default: False
+            error (dict, optional): rmse and rel_error of the compression
+        """
+
+        assert codes.ndim == 3 and codes.shape[1] == basis.shape[0], \
+            'codes should be [N x rank x K], with rank matching the basis'
+        self.codes = codes
+        self.mean = mean
+        self.basis = basis
+        self.squeeze = squeeze and codes.shape[2] == 1
+        self._error = {} if error is None else error
+
+    @property
+    def shape(self):
+        shape = (self.codes.shape[0], self.basis.shape[1], self.codes.shape[2])
+        return shape[:2] if self.squeeze else shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def rank(self):
+        return self.basis.shape[0]
+
+    @property
+    def rmse(self):
+        return self._error.get('rmse')
+
+    @property
+    def rel_error(self):
+        return self._error.get('rel_error')
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.mean.nbytes + self.basis.nbytes
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.decode(self.codes[[idx]])[0]
+        return PCAPatches(self.codes[idx], self.mean, self.basis, self.squeeze, self._error)
+
+    def __array__(self, dtype=None, copy=None):
+        patches = self.decode()
+        return patches if dtype is None else patches.astype(dtype)
+
+    def decode(self, codes=None):
+        """
+        reconstruct patches from codes (default: all the codes of the container)
+
+        Returns:
+            [B x V] or [B x V x K] array of patches
+        """
+
+        if codes is None:
+            codes = self.codes
+        patches = np.matmul(self.basis.T, codes.astype(float)) + self.mean[:, np.newaxis]
+        return patches[..., 0] if self.squeeze else patches
+
+
+class PatchGrid(object):
+    """
+    random-access view of all the (gridded) patches of a volume, e.g. for data loaders
+
+    Supports len(), zero-copy access to single patches with pgrid[i] (in the order of patch_gen),
+    and slices or index arrays (returning [B x *patch_size] arrays, or [B x *patch_size x C] for
+    volumes with a trailing channel axis). Only the geometry and a
+    reference to the volume are held: pickling a PatchGrid over a file-backed np.memmap (or .npy
+    path) or over shared memory only sends the file name or shared memory name, so that worker
+    processes open the volume without copying or re-reading it. Other arrays are pickled with
+    their data.
+    """
+
+    def __init__(self, vol, patch_size, patch_stride=1, shared=False):
+        """
+        Parameters:
+            vol: the n-d volume, as an array, np.memmap or the path of a .npy file (which is
+                memory-mapped)
+            patch_size (numpy vector): the size of the patches
+            patch_stride (int or numpy vector, optional): stride (separation) in each dimension.
+                default: 1
+            shared (logical, optional): whether to copy an in-memory vol into shared memory,
+                which is then owned by this object and released by close(). default: False
+        """
+
+        if isinstance(vol, (str, os.PathLike)):
+            vol = np.load(vol, mmap_mode='r')
+        self._shm, self._owner = None, False
+        if shared and _memmap_spec(vol) is None:
+            self._shm, vol = _to_shared(np.asarray(vol))
+            self._owner = True
+        self._set_geometry(vol, patch_size, patch_stride)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return int(np.prod(self.grid_size))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            assert 0 <= idx < len(self), 'index %d out of range' % idx
+            return self._view[np.unravel_index(idx, self.grid_size)]
+
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+        return self._view[np.unravel_index(idx, self.grid_size)]
+
+    def __getstate__(self):
+        spec = _memmap_spec(self.vol)
+        if spec is None and self._shm is not None:
+            spec = ('shm', self._shm.name, self.vol.shape, self.vol.dtype)
+        return dict(spec=spec, vol=self.vol if spec is None else None,
+                    patch_size=self.patch_size, patch_stride=self.patch_stride)
+
+    def __setstate__(self, state):
+        vol, self._shm, self._owner = state['vol'], None, False
+        if state['spec'] is not None:
+            vol, self._shm = _open_spec(state['spec'])
+        self._set_geometry(vol, state['patch_size'], state['patch_stride'])
+
+    def start_sub(self, idx):
+        """
+        subscripts of the starting voxel of patches
+
+        Returns:
+            [*idx.shape x nb_dims] array of subscripts into the volume
+        """
+
+        idx = np.asarray(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+        return np.stack(np.unravel_index(idx, self.grid_size), -1) * self.patch_stride
+
+    def close(self):
+        """
+        release the shared memory of the volume, if any. Unpickled copies only detach from it,
+        and the object that created it also frees it.
+        """
+
+        if self._shm is None:
+            return
+        del self.vol, self._view
+        if self._owner:
+            self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # patches are still in use, the memory is released along with them
+        self._shm = None
+
+    def _set_geometry(self, vol, patch_size, patch_stride):
+        self.vol = vol
+        self.patch_size = np.array(patch_size, 'int')
+        if isinstance(patch_stride, (int, np.integer)):
+            patch_stride = np.repeat(patch_stride, len(self.patch_size))
+        self.patch_stride = np.array(patch_stride, 'int')
+        self.grid_size = gridsize(vol.shape[:len(self.patch_size)], self.patch_size,
+                                  self.patch_stride)
+        self._view = patch_view(vol, self.patch_size, self.patch_stride)
 
 
 # local helper functions
 
+def _grid_order(grid_size, batch_size=4096, rand=False, rand_seed=None, nb_samples=None,
+                replace=False, grid_prob=None):
+    """
+    order in which to visit the locations of a grid, optionally randomized, computed lazily
+
+    Parameters:
+        grid_size: the size of the grid
+        batch_size: the number of locations in each yielded batch (the last one may be smaller)
+        rand: whether to randomize the order. If False, other options are ignored.
+        rand_seed: seed of the local random generator
+        nb_samples: the number of locations to sample (see patch_sampler())
+        replace: whether to sample with replacement
+        grid_prob: optional [*grid_size] mask or probability of each grid location
+
+    Yields:
+        batches of linear indexes into the grid
+    """
+
+    nb_locs = int(np.prod(grid_size))
+    if not rand:
+        for first in range(0, nb_locs, batch_size):
+            yield np.arange(first, min(first + batch_size, nb_locs))
+        return
+
+    rng = np.random.default_rng(rand_seed)
+    is_mask = grid_prob is not None and grid_prob.dtype == bool
+
+    if replace:
+        assert nb_samples is not None, 'nb_samples is required when sampling with replacement'
+        if grid_prob is not None:
+            cdf = np.cumsum(grid_prob.ravel(), dtype=float)
+            assert cdf[-1] > 0, 'prob_map has no non-zero entries in the grid'
+        for first in range(0, nb_samples, batch_size):
+            size = min(batch_size, nb_samples - first)
+            if grid_prob is None:
+                yield rng.integers(0, nb_locs, size)
+            else:
+                yield np.searchsorted(cdf, rng.random(size) * cdf[-1], side='right')
+
+    elif grid_prob is None or is_mask:
+        # walk a random permutation of the grid, skipping locations outside of the mask
+        if grid_prob is None:
+            orders = _random_permutation(nb_locs, rng, batch_size)
+        else:
+            mask = grid_prob.ravel()
+            orders = (f[mask[f]] for f in _random_permutation(nb_locs, rng, batch_size))
+        yield from _rebatch(orders, batch_size, nb_samples)
+
+    else:
+        prob = np.ravel(grid_prob) / np.sum(grid_prob)
+        if nb_samples is None:
+            nb_samples = np.count_nonzero(prob)
+        order = rng.choice(nb_locs, nb_samples, replace=False, p=prob)
+        for first in range(0, nb_samples, batch_size):
+            yield order[first:(first + batch_size)]
+
+
+def _grid_prob(prob_map, patch_size, patch_stride, grid_size):
+    """
+    view of the probability (or mask) value at the center of every patch in the grid
+    """
+
+    center = [f // 2 for f in patch_size]
+    return prob_map[tuple(slice(c, c + (g - 1) * s + 1, s)
+                          for c, s, g in zip(center, patch_stride, grid_size))]
+
+
+def _random_permutation(nb_items, rng, batch_size, nb_rounds=4):
+    """
+    lazy random permutation of range(nb_items), in batches
+
+    Uses a Feistel network (a bijection on [0, 2^(2 * half_bits))) with random round keys,
+    and cycle-walks values that fall outside of range(nb_items). Memory is O(batch_size).
+    """
+
+    half_bits = max(1, (int(nb_items - 1).bit_length() + 1) // 2)
+    mask = np.uint64((1 << half_bits) - 1)
+    shift = np.uint64(half_bits)
+    keys = rng.integers(0, np.iinfo(np.int64).max, nb_rounds).astype(np.uint64)
+
+    def feistel(x):
+        left, right = x >> shift, x & mask
+        for key in keys:
+            hsh = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+            hsh ^= hsh >> np.uint64(29)
+            left, right = right, (left ^ hsh) & mask
+        return (left << shift) | right
+
+    for first in range(0, nb_items, batch_size):
+        perm = feistel(np.arange(first, min(first + batch_size, nb_items), dtype=np.uint64))
+        outside = perm >= nb_items
+        while np.any(outside):
+            perm[outside] = feistel(perm[outside])
+            outside = perm >= nb_items
+        yield perm.astype(np.int64)
+
+
+def _rebatch(batches, batch_size, nb_items=None):
+    """
+    regroup a stream of 1D arrays into arrays of batch_size entries (optionally capped to
+    nb_items entries in total)
+    """
+
+    pending = []
+    nb_pending = 0
+    nb_done = 0
+    for batch in batches:
+        pending.append(batch)
+        nb_pending += len(batch)
+        while nb_pending >= batch_size or (nb_items is not None and
+                                           nb_done + nb_pending >= nb_items):
+            merged = np.concatenate(pending)
+            size = batch_size if nb_items is None else min(batch_size, nb_items - nb_done)
+            if size <= 0:
+                return
+            yield merged[:size]
+            nb_done += size
+            pending = [merged[size:]]
+            nb_pending = len(pending[0])
+
+    if nb_pending > 0 and (nb_items is None or nb_done < nb_items):
+        yield np.concatenate(pending)
+
+
 def _mod_base(num, div, base=0):
     """
     modulo with respect to a specific base numbering system
@@ -452,3 +1737,476 @@ def _mod_base(num, div, base=0):
     """
 
     return base + np.mod(num - base, div)
+
+
+def _patch_vox_idx(start_idx, patch_size, vol_size):
+    """
+    linear indexes of all the voxels of patches starting at start_idx
+
+    Parameters:
+        start_idx (array_like): linear indexes of the patch starting points in vol_size
+        patch_size (vector): the size of the patches
+        vol_size (vector): the size of the volume being indexed
+
+    Returns:
+        [N x V] int array, where N = start_idx.size and V = prod(patch_size). Voxels are
+            ordered like a flattened patch of size patch_size
+    """
+
+    patch_sub = np.reshape(np.indices(patch_size), [len(patch_size), -1])
+    offsets = nd.sub2ind(patch_sub, vol_size)
+    return np.reshape(start_idx, [-1, 1]) + offsets.reshape(1, -1)
+
+
+def _reduce_votes(layers, axis, func):
+    """
+    reduce the (non-nan) votes along an axis, grouping voxels by their number of votes
+
+    func(votes, nb_votes) gets a [M x L] array whose rows each have nb_votes valid votes followed
+    by (L - nb_votes) +inf, in any order, and returns the [M] reduced votes.
+    """
+
+    votes = np.moveaxis(layers, axis, -1)
+    out_shape = votes.shape[:-1]
+    votes = np.reshape(votes, [-1, votes.shape[-1]])
+    nb_votes = votes.shape[1] - np.sum(np.isnan(votes), 1)
+
+    out = np.full(votes.shape[0], np.nan)
+    for count in np.unique(nb_votes):
+        if count == 0:
+            continue
+        rows = np.where(nb_votes == count)[0]
+        group = votes[rows]
+        group[np.isnan(group)] = np.inf
+        out[rows] = func(group, count)
+
+    return np.reshape(out, out_shape)
+
+
+# patch store file names
+_STORE_HEADER = 'header.json'
+_STORE_INDEX = 'index.npy'
+
+
+def _store_chunk_file(chunk_id, compress):
+    return 'chunk_%06d.%s' % (chunk_id, 'npz' if compress else 'npy')
+
+
+def _store_index(nb_patches, nb_dims):
+    """
+    empty index table of a patch store: the source volume and starting subscript of each patch
+    """
+
+    return np.zeros(nb_patches, dtype=[('volume', 'int32'), ('start', 'int32', (nb_dims, ))])
+
+
+def _geometry_key(vec, nb_dims):
+    """
+    hashable (tuple of ints) version of a size, stride or subscript vector, for caching
+    """
+
+    return tuple(np.broadcast_to(np.array(vec, 'int'), [nb_dims]).tolist())
+
+
+@functools.lru_cache(maxsize=64)
+def _gridsize(vol_size, patch_size, patch_stride, start_sub):
+    """
+    cached grid size computation for gridsize(), taking tuples of ints
+    """
+
+    vol_size, patch_size, patch_stride, start_sub = \
+        [np.array(f, 'int') for f in (vol_size, patch_size, patch_stride, start_sub)]
+
+    # adjacent patch overlap
+    patch_overlap = patch_size - patch_stride
+
+    # modified volume size if starting late
+    mod_vol_size = vol_size - start_sub
+    assert np.all(np.array(mod_vol_size) > 0), "New volume size is non-positive"
+
+    # compute the number of patches
+    # the final volume size will be
+    # >> grid_size * patch_stride + patch_overlap
+    # thus the part that is a multiplier of patch_stride is vol_size - patch_overlap
+    patch_stride_multiples = mod_vol_size - patch_overlap  # not sure?
+    grid_size = np.floor(patch_stride_multiples / patch_stride).astype('int')
+    assert np.all(np.array(grid_size) > 0), "Grid size is non-positive"
+    return tuple(grid_size.tolist())
+
+
+# least recently used grids, bounded by their total size in bytes rather than by their number,
+# so that a few large volumes do not pin gigabytes of indexes
+_GRID_CACHE = OrderedDict()
+_GRID_CACHE_BYTES = 2 ** 26
+_GRID_CACHE_LOCK = threading.Lock()
+
+
+def _grid(vol_size, patch_size, patch_stride, start_sub, grid_type, dtype):
+    """
+    cached grid computation for grid(), taking tuples of ints. Returns read-only arrays.
+    Grids larger than _GRID_CACHE_BYTES are recomputed on each call.
+    """
+
+    key = (vol_size, patch_size, patch_stride, start_sub, grid_type, dtype)
+    with _GRID_CACHE_LOCK:
+        if key in _GRID_CACHE:
+            _GRID_CACHE.move_to_end(key)
+            return _GRID_CACHE[key][0]
+
+    idx, nb_bytes = _grid_arrays(*key)
+    if nb_bytes <= _GRID_CACHE_BYTES:
+        with _GRID_CACHE_LOCK:
+            _GRID_CACHE[key] = (idx, nb_bytes)
+            total = sum(f[1] for f in _GRID_CACHE.values())
+            while total > _GRID_CACHE_BYTES:
+                total -= _GRID_CACHE.popitem(last=False)[1][1]
+    return idx
+
+
+def _grid_arrays(vol_size, patch_size, patch_stride, start_sub, grid_type, dtype):
+    """
+    grid computation for _grid(). Returns the grid and the number of bytes it holds: 'sub'
+    grids are broadcast views of the per-axis starting points, and hold only those.
+
+    The linear indexes are computed directly from the per-axis patch starting points, with
+    broadcasting, rather than by indexing into a prod(vol_size) array of all indexes.
+    """
+
+    grid_size = _gridsize(vol_size, patch_size, patch_stride, start_sub)
+    nb_dims = len(grid_size)
+    if grid_type == 'idx':
+        assert np.prod(vol_size) <= np.iinfo(dtype).max, \
+            'dtype %s is too small to index a volume of size %s' % (dtype, pformat(vol_size))
+
+    # the patch starting points in each dimension
+    xvec = [np.arange(start_sub[d], start_sub[d] + grid_size[d] * patch_stride[d],
+                      patch_stride[d], dtype=dtype) for d in range(nb_dims)]
+    xvec = [np.reshape(x, [-1 if d == f else 1 for f in range(nb_dims)])
+            for d, x in enumerate(xvec)]
+
+    if grid_type == 'idx':
+        # broadcasted sub2ind: sum of the starting points times the volume strides
+        vol_strides = np.cumprod([1, *vol_size[:0:-1]])[::-1]
+        idx = np.zeros(grid_size, dtype)
+        for d in range(nb_dims):
+            idx += xvec[d] * vol_strides[d].astype(dtype)
+        idx.flags.writeable = False
+        return (idx, idx.nbytes)
+    else:
+        idx = tuple(np.broadcast_to(x, grid_size) for x in xvec)
+        return (idx, sum(x.nbytes for x in xvec))
+
+
+def _target_size(patches, grid_size, patch_size, patch_stride):
+    """
+    the target (volume) size from either the grid size or the target size, as passed to
+    stack() and quilt(). grid_size is a grid size if it matches the number of patches, or if
+    the number of patches is unknown (e.g. patches is a generator).
+    """
+
+    if not hasattr(patches, 'shape') or np.prod(grid_size) == patches.shape[0]:
+        return grid2volsize(grid_size, patch_size, patch_stride=patch_stride)
+    else:
+        return np.array(grid_size, 'int')
+
+
+def _target_grid(target_size, patch_size, patch_stride):
+    """
+    the flattened grid linear indexes in target_size, checking that the grid fills the target
+    """
+
+    [grid_idx, target_size_chk] = grid(target_size, patch_size, patch_stride, nargout=2)
+    assert np.all(target_size == target_size_chk), 'Target does not match the provided target size'
+    return grid_idx.ravel()
+
+
+def _patch_chunks(patches, nb_vox, batch_size):
+    """
+    split patches into consecutive chunks
+
+    Parameters:
+        patches: [N x V] or [N x V x K] array, or iterable of patches with V or V x K entries
+        nb_vox: the number of voxels in a patch (V)
+        batch_size: the (maximum) number of patches in each chunk
+
+    Yields:
+        (first, chunk) with first the index of the first patch in the chunk, and chunk a
+            [B x V x K] array
+    """
+
+    if hasattr(patches, 'shape'):
+        for first in range(0, patches.shape[0], batch_size):
+            chunk = patches[first:(first + batch_size)]
+            yield (first, np.reshape(chunk, [chunk.shape[0], nb_vox, -1]))
+
+    else:
+        patch_iter = iter(patches)
+        first = 0
+        while True:
+            chunk = [np.reshape(f, [nb_vox, -1]) for f in islice(patch_iter, batch_size)]
+            if len(chunk) == 0:
+                break
+            yield (first, np.stack(chunk, 0))
+            first += len(chunk)
+
+
+def _quilt_accumulate(patches, start_idx, patch_size, target_size, weights=None, window=None,
+                      batch_size=4096, nb_channels=None):
+    """
+    average patches into a volume through running sums and counts
+
+    Parameters:
+        patches: [N x V (x K)] patches, or iterable of patches, see _patch_chunks()
+        start_idx: [N] linear indexes of the patch starting points in target_size
+        patch_size: the size of the patches
+        target_size: the size of the volume
+        weights, window (optional): see quilt(). If either is given, the K candidates are
+            combined with the overlapping patches.
+        batch_size: number of patches processed at once
+        nb_channels (optional): number of channels C, which are stacked with the K candidates
+            in the patches (as V x K x C)
+
+    Returns:
+        [*target_size x K] volume, or [*target_size x K x C] with channels (K = 1 if weights or
+            window are given)
+    """
+
+    weighted = weights is not None or window is not None
+    nb_chan = 1 if nb_channels is None else nb_channels
+    if weights is not None:
+        weights = np.reshape(np.transpose(np.reshape(weights, [start_idx.size, -1])),
+                             [1, -1, 1, start_idx.size])
+    if window is not None:
+        assert np.all(np.array(window.shape) == np.array(patch_size)), \
+            "window shape %s does not match patch size %s" % \
+            (pformat(window.shape), pformat(patch_size))
+        window = np.reshape(window, [-1, 1, 1, 1])
+
+    # running sums and counts (total weights) of the (non-nan) votes at each voxel
+    sums, counts = None, None
+    for first, chunk in _patch_chunks(patches, np.prod(patch_size), batch_size):
+        last = first + chunk.shape[0]
+
+        # [V x K x B] values and votes (transposed while masking the nans), so that each
+        # voxel offset of the patches is a contiguous block in _accumulate
+        chunk = np.moveaxis(chunk, 0, -1)
+        votes = np.empty(chunk.shape, 'bool')
+        np.isnan(chunk, out=votes)
+        np.logical_not(votes, out=votes)
+        values = np.zeros(chunk.shape)
+        np.copyto(values, chunk, where=votes)
+
+        # weight the votes and combine the candidates (but not the channels) in the same pass
+        if weighted:
+            cand_shape = [chunk.shape[0], -1, nb_chan, chunk.shape[2]]
+            values = np.reshape(values, cand_shape)
+            votes = np.reshape(votes, cand_shape)
+            if weights is not None:
+                votes = votes * weights[..., first:last]
+            if window is not None:
+                votes = votes * window
+            values = np.sum(values * votes, 1)
+            votes = np.sum(votes, 1)
+
+        if sums is None:
+            sums = np.zeros([np.prod(target_size), values.shape[1]])
+            counts = np.zeros([np.prod(target_size), values.shape[1]])
+        _accumulate(sums, counts, start_idx[first:last], values, votes, patch_size, target_size)
+    assert sums is not None, 'no patches given'
+    assert last == start_idx.size, \
+        'number of patches (%d) does not match the locations (%d)' % (last, start_idx.size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        quilted_vol_k = sums / counts
+    if nb_channels is None:
+        return np.reshape(quilted_vol_k, [*target_size, -1])
+    return np.reshape(quilted_vol_k, [*target_size, -1, nb_channels])
+
+
+def _accumulate(sums, counts, start_idx, values, votes, patch_size, vol_size):
+    """
+    add a chunk of patch votes to running sums and counts, in place
+
+    Parameters:
+        sums: [prod(vol_size) x K] (contiguous) running sum of (weighted) votes
+        counts: [prod(vol_size) x K] (contiguous) running count (or total weight) of votes
+        start_idx: [B] linear indexes of the patch starting points in vol_size
+        values: [V x K x B] (contiguous) patch values to add to sums (zero where there is no
+            vote)
+        votes: [V x K x B] (contiguous) number (or weight) of votes to add to counts
+        patch_size: the size of the patches
+        vol_size: the size of the volume being accumulated
+    """
+
+    # index the flattened sums and counts, since 1-d fancy indexing is much faster than
+    # indexing the rows of the [prod(vol_size) x K] arrays
+    nb_cols = sums.shape[1]
+    sums, counts = sums.reshape(-1), counts.reshape(-1)
+    start_idx = (start_idx * nb_cols + np.arange(nb_cols)[:, np.newaxis]).ravel()
+    offsets = _patch_vox_idx(0, patch_size, vol_size).flatten() * nb_cols
+    values = np.reshape(values, [len(offsets), -1])
+    votes = np.reshape(votes, [len(offsets), -1])
+
+    # if the patches have different starting points, for a given voxel offset within the patch
+    # the voxels they land on are all different, and fancy-indexed updates are safe.
+    # Otherwise, use the (slower) unbuffered np.add.at
+    unique = np.unique(start_idx).size == start_idx.size
+    for v, offset in enumerate(offsets):
+        vox_idx = start_idx + offset
+        if unique:
+            sums[vox_idx] += values[v]
+            counts[vox_idx] += votes[v]
+        else:
+            np.add.at(sums, vox_idx, values[v])
+            np.add.at(counts, vox_idx, votes[v])
+
+
+def _grid_tiles(target_size, grid_size, patch_size, patch_stride, nb_tiles):
+    """
+    split a target volume into slabs along the first dimension
+
+    Returns:
+        list of (out_start, out_end, grid_start, grid_end) tuples, where [out_start, out_end) are
+            the rows of the target in the tile, and [grid_start, grid_end) are the grid rows of
+            all the patches that overlap them.
+    """
+
+    nb_tiles = int(max(1, min(nb_tiles, target_size[0])))
+    bounds = np.linspace(0, target_size[0], nb_tiles + 1).round().astype('int')
+
+    tiles = []
+    for out_start, out_end in zip(bounds[:-1], bounds[1:]):
+        grid_start = max(0, -(-(out_start - patch_size[0] + 1) // patch_stride[0]))
+        grid_end = min(grid_size[0], (out_end - 1) // patch_stride[0] + 1)
+        tiles.append((out_start, out_end, grid_start, grid_end))
+    return tiles
+
+
+def _quilt_tile(tile, patch_size, grid_size, patch_stride, quilt_kwargs, arrays=None):
+    """
+    quilt the patches overlapping a tile (see _grid_tiles), and write the tile to the output
+    """
+
+    if arrays is None:
+        arrays = _shared_arrays
+    out_start, out_end, grid_start, grid_end = tile
+
+    # no patch covers the tile (e.g. a gap between patches when patch_stride > patch_size)
+    if grid_start >= grid_end:
+        arrays['out'][out_start:out_end] = np.nan
+        return
+
+    # the patches (and weights) of the block of grid rows overlapping the tile
+    nb_row_patches = np.prod(grid_size[1:])
+    rows = slice(grid_start * nb_row_patches, grid_end * nb_row_patches)
+    weights = arrays.get('weights')
+    if weights is not None:
+        weights = weights[rows]
+
+    tile_grid_size = [grid_end - grid_start, *grid_size[1:]]
+    vol = quilt(arrays['patches'][rows], patch_size, tile_grid_size, patch_stride,
+                weights=weights, **quilt_kwargs)
+
+    # crop to the tile. With patch_stride > patch_size, the quilted rows may not span the whole
+    # tile, and the rows that no patch covers are nan (as in quilt)
+    offset = grid_start * patch_stride[0]
+    start, end = max(out_start, offset), min(out_end, offset + vol.shape[0])
+    if start > out_start or end < out_end:
+        arrays['out'][out_start:out_end] = np.nan
+    arrays['out'][start:end] = vol[(start - offset):(end - offset)]
+
+
+# arrays shared with a worker process, see _attach_shared
+_shared_arrays = {}
+
+
+def _to_shared(arr, shape=None, dtype=None):
+    """
+    create a shared memory block, optionally holding a copy of arr
+
+    Returns:
+        (shm, view) with shm the SharedMemory object and view a numpy array backed by it
+    """
+
+    if arr is not None:
+        shape, dtype = arr.shape, arr.dtype
+    nb_bytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=nb_bytes)
+    view = np.ndarray(shape, dtype, buffer=shm.buf)
+    if arr is not None:
+        view[:] = arr
+    return (shm, view)
+
+
+def _vol_info(vol):
+    """
+    (shape, dtype) of a volume given as an array or a .npy path, without loading the data
+    """
+
+    if isinstance(vol, (str, os.PathLike)):
+        vol = np.load(vol, mmap_mode='r')
+    return (vol.shape, vol.dtype)
+
+
+def _extract_patches(vol, patch_size, patch_stride, first=None, out=None):
+    """
+    patch_matrix() of a volume (array or .npy path). If first is given, the patches are written
+    into out (default: the shared 'out' array of a worker) starting at row first.
+    """
+
+    if isinstance(vol, (str, os.PathLike)):
+        vol = np.load(vol, mmap_mode='r')
+    if first is None:
+        return patch_matrix(vol, patch_size, patch_stride)
+
+    if out is None:
+        out = _shared_arrays['out']
+    nb_patches = np.prod(gridsize(vol.shape[:len(patch_size)], patch_size, patch_stride))
+    patch_matrix(vol, patch_size, patch_stride, out=out[first:(first + nb_patches)])
+
+
+def _memmap_spec(arr):
+    """
+    ('memmap', filename, offset, shape, dtype) spec to re-open a file-backed np.memmap in
+    another process, or None if arr is not a (whole, C-ordered) file-backed memmap, or if its
+    file no longer exists (e.g. the output of patch_matrix_batch)
+    """
+
+    if not isinstance(arr, np.memmap) or not isinstance(arr.base, mmap.mmap) \
+            or arr.filename is None or not arr.flags.c_contiguous \
+            or not os.path.isfile(arr.filename):
+        return None
+    return ('memmap', arr.filename, arr.offset, arr.shape, arr.dtype)
+
+
+def _attach_shared(specs):
+    """
+    worker process initializer: attach to shared memory blocks or memmaps given by
+    {key: ('shm', name, shape, dtype)} or {key: ('memmap', filename, offset, shape, dtype)}, and
+    expose them as numpy arrays in _shared_arrays.
+    The shared memory blocks are owned (and unlinked) by the parent process.
+    """
+
+    for key, spec in specs.items():
+        _shared_arrays[key], shm = _open_spec(spec, 'r+' if key == 'out' else 'r')
+        if shm is not None:
+            _shared_arrays[key + '_shm'] = shm
+
+
+def _open_spec(spec, mode='r'):
+    """
+    open an array given by a ('shm', name, shape, dtype) or ('memmap', filename, offset, shape,
+    dtype) spec
+
+    Returns:
+        (arr, shm) with shm the attached SharedMemory object (None for memmaps), which needs to
+            be kept alive as long as arr is used
+    """
+
+    if spec[0] == 'memmap':
+        _, filename, offset, shape, dtype = spec
+        return (np.memmap(filename, dtype, mode, offset, shape), None)
+
+    _, name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return (np.ndarray(shape, dtype, buffer=shm.buf), shm)
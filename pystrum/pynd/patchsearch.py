@@ -0,0 +1,269 @@
+"""
+patch library search
+
+K-nearest neighbour search of patches in a library of patches (e.g. extracted with
+patchlib.patch_gen or patchlib.patch_matrix from training volumes). The results can be passed
+to patchlib.quilt to reconstruct a volume, for patch-based segmentation or super-resolution.
+
+example:
+    lib = PatchLibrary(patchlib.patch_matrix(train_vol, patch_size), pca_rank=10)
+    idx, dst = lib.query(patchlib.patch_matrix(test_vol, patch_size), k=3)
+    vol = patchlib.quilt(lib.gather(idx), patch_size, grid_size, weights=np.exp(-dst ** 2))
+"""
+
+# third party
+import numpy as np
+
+# local
+from . import patchlib
+
+
+class PatchLibrary(object):
+    """
+    index of a library of patches for batched K-nearest neighbour (Euclidean) search
+
+    Two search methods are available:
+        'exact': brute force search, computing blocks of distances with matrix products
+        'rptree': approximate search in a forest of random projection trees. Each query is
+            only compared to the library patches in the leaves it falls in, one per tree.
+
+    Optionally, the patches are first reduced with PCA (see patchlib.patch_pca), and the
+    distances are computed in the reduced space.
+    """
+
+    def __init__(self, patches, pca_rank=None, pca_samples=10000, method='exact', nb_trees=4,
+                 leaf_size=64, rand_seed=None):
+        """
+        Parameters:
+            patches: [M x V] matrix of library patches. Kept by reference for gather().
+            pca_rank (int, optional): if given, reduce the patches to this many PCA components
+            pca_samples (int, optional): number of patches used to fit the PCA. default: 10000
+            method (optional, default:'exact'): 'exact' or 'rptree'
+            nb_trees (int, optional): number of random projection trees ('rptree' only)
+            leaf_size (int, optional): maximum number of patches in a tree leaf ('rptree' only)
+            rand_seed (number, optional): random seed for the PCA subsample and the trees
+        """
+
+        assert method in ('exact', 'rptree'), "method should be 'exact' or 'rptree'"
+        self.patches = patches
+        self.method = method
+        rng = np.random.default_rng(rand_seed)
+
+        # reduce the library
+        self.pca = None
+        if pca_rank is not None:
+            self.pca = patchlib.patch_pca(patches, pca_rank, pca_samples,
+                                          rand_seed=rng.integers(2 ** 31))
+        self.features = self._features(patches)
+        self.sq_norms = np.sum(np.square(self.features), 1)
+
+        # build the trees
+        if method == 'rptree':
+            self.trees = [_rptree(self.features, leaf_size, rng) for _ in range(nb_trees)]
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def query(self, queries, k=1, batch_size=1024):
+        """
+        K nearest library patches of each query patch
+
+        Parameters:
+            queries: [N x V] matrix of query patches
+            k (int, optional): number of neighbours. default: 1
+            batch_size (int, optional): number of queries processed at once. default: 1024
+
+        Returns:
+            (idx, dst): [N x k] indexes into the library and [N x k] Euclidean distances, sorted
+                by increasing distance. If fewer than k library patches are found for a query
+                ('rptree' method), the remaining entries have index -1 and distance inf.
+        """
+
+        nb_queries = queries.shape[0]
+        idx = np.empty([nb_queries, k], 'int')
+        dst = np.empty([nb_queries, k])
+        for first in range(0, nb_queries, batch_size):
+            batch = self._features(queries[first:(first + batch_size)])
+            if self.method == 'exact':
+                bidx, bdst = self._query_exact(batch, k)
+            else:
+                bidx, bdst = self._query_rptree(batch, k)
+            idx[first:(first + batch.shape[0])] = bidx
+            dst[first:(first + batch.shape[0])] = bdst
+
+        return (idx, np.sqrt(np.maximum(dst, 0)))
+
+    def gather(self, idx):
+        """
+        library patches for the given indexes, e.g. from query(), in the [N x V x K] layout
+        expected by patchlib.quilt. Missing neighbours (index -1) are nan.
+        """
+
+        patches = np.asarray(self.patches)[np.maximum(idx, 0)].astype(float)
+        patches[idx < 0] = np.nan
+        return np.transpose(patches, [0, 2, 1])
+
+    def _features(self, patches):
+        """
+        the (possibly PCA-reduced) features used for the search
+        """
+
+        patches = np.asarray(np.reshape(patches, [patches.shape[0], -1]), float)
+        if self.pca is None:
+            return patches
+        mean, basis = self.pca
+        return (patches - mean) @ basis.T
+
+    def _query_exact(self, batch, k, block_size=4096):
+        """
+        exact search of a batch of queries, going through blocks of the library. Each block is
+        first reduced to its own k best, so only [batch x 2k] entries are merged.
+        """
+
+        best_idx = np.full([batch.shape[0], k], -1)
+        best_dst = np.full([batch.shape[0], k], np.inf)
+        batch_sq_norms = np.sum(np.square(batch), 1, keepdims=True)
+        for first in range(0, len(self), block_size):
+            block = slice(first, first + block_size)
+            dst = batch_sq_norms - 2 * batch @ self.features[block].T + self.sq_norms[block]
+            if dst.shape[1] > k:
+                idx = np.argpartition(dst, k - 1, 1)[:, :k]
+                dst = np.take_along_axis(dst, idx, 1)
+            else:
+                idx = np.broadcast_to(np.arange(dst.shape[1]), dst.shape)
+
+            # merge with the best so far
+            dst = np.concatenate([best_dst, dst], 1)
+            idx = np.concatenate([best_idx, idx + first], 1)
+            best_idx, best_dst = _top_k(idx, dst, k)
+
+        return (best_idx, best_dst)
+
+    def _query_rptree(self, batch, k, block_size=2 ** 22):
+        """
+        approximate search of a batch of queries, comparing them to the patches in their leaves.
+        The candidate features are gathered for groups of queries of at most block_size values.
+        """
+
+        # candidates from all the trees, without repeats
+        cand = np.concatenate([_rptree_leaves(tree, batch) for tree in self.trees], 1)
+        cand = np.sort(cand, 1)
+        cand[:, 1:][cand[:, 1:] == cand[:, :-1]] = -1
+
+        # distances to the candidates
+        dst = np.empty(cand.shape)
+        step = max(1, block_size // max(1, cand.shape[1] * batch.shape[1]))
+        for first in range(0, batch.shape[0], step):
+            rows = slice(first, first + step)
+            feats = self.features[np.maximum(cand[rows], 0)]
+            dst[rows] = np.sum(np.square(feats - batch[rows, np.newaxis, :]), 2)
+        dst[cand < 0] = np.inf
+
+        if cand.shape[1] < k:
+            pad = k - cand.shape[1]
+            cand = np.pad(cand, [[0, 0], [0, pad]], constant_values=-1)
+            dst = np.pad(dst, [[0, 0], [0, pad]], constant_values=np.inf)
+        idx, dst = _top_k(cand, dst, k)
+        idx[np.isinf(dst)] = -1
+        return (idx, dst)
+
+
+###############################################################################
+# internal
+###############################################################################
+
+def _top_k(idx, dst, k):
+    """
+    the k entries with the smallest distances in each row, sorted by distance
+    """
+
+    if dst.shape[1] > k:
+        part = np.argpartition(dst, k - 1, 1)[:, :k]
+        idx = np.take_along_axis(idx, part, 1)
+        dst = np.take_along_axis(dst, part, 1)
+    order = np.argsort(dst, 1)
+    return (np.take_along_axis(idx, order, 1), np.take_along_axis(dst, order, 1))
+
+
+def _rptree(features, leaf_size, rng):
+    """
+    random projection tree: each node splits its points at the median of their projection on a
+    random direction, until nodes have at most leaf_size points. Ties at the median are sent
+    right when possible, and nodes whose points all project onto the same value are split in
+    random halves, so no leaf grows past leaf_size even for many identical points.
+
+    Returns:
+        dict of node arrays (direction, threshold, children; leaf id or -1) and the leaves in
+            compressed form: the point indexes of leaf i are leaf_idx[leaf_ptr[i]:leaf_ptr[i+1]]
+    """
+
+    directions, thresholds, children, leaf_ids, leaves = [], [], [], [], []
+    stack = [(np.arange(features.shape[0]), None)]
+    while len(stack) > 0:
+        idx, parent = stack.pop()
+        node = len(thresholds)
+        if parent is not None:
+            children[parent[0]][parent[1]] = node
+
+        # split at the median of a random projection
+        left = None
+        if idx.size > leaf_size:
+            direction = rng.standard_normal(features.shape[1])
+            proj = features[idx] @ direction
+            threshold = np.median(proj)
+            left = proj <= threshold
+            if np.all(left):
+                below = proj < threshold
+                if np.any(below):
+                    # more than half the points tie at the maximum: split them from the rest
+                    threshold = np.max(proj[below])
+                    left = below
+                else:
+                    # all the points project onto the same value: split them arbitrarily
+                    left = rng.permutation(idx.size) < (idx.size // 2)
+
+        if left is None:
+            # leaf
+            directions.append(np.zeros(features.shape[1]))
+            thresholds.append(0)
+            children.append([-1, -1])
+            leaf_ids.append(len(leaves))
+            leaves.append(idx)
+            continue
+
+        directions.append(direction)
+        thresholds.append(threshold)
+        children.append([-1, -1])
+        leaf_ids.append(-1)
+        stack.append((idx[np.logical_not(left)], (node, 1)))
+        stack.append((idx[left], (node, 0)))
+
+    leaf_ptr = np.concatenate([[0], np.cumsum([f.size for f in leaves])])
+
+    return dict(directions=np.array(directions), thresholds=np.array(thresholds),
+                children=np.array(children, 'int'), leaf_ids=np.array(leaf_ids, 'int'),
+                leaf_idx=np.concatenate(leaves), leaf_ptr=leaf_ptr.astype('int'))
+
+
+def _rptree_leaves(tree, queries):
+    """
+    library point indexes in the leaf each query falls in, [N x S] (padded with -1), where S is
+    the size of the largest of these leaves
+    """
+
+    nodes = np.zeros(queries.shape[0], 'int')
+    internal = tree['leaf_ids'][nodes] < 0
+    while np.any(internal):
+        qidx = np.where(internal)[0]
+        inodes = nodes[qidx]
+        proj = np.sum(queries[qidx] * tree['directions'][inodes], 1)
+        side = (proj > tree['thresholds'][inodes]).astype('int')
+        nodes[qidx] = tree['children'][inodes, side]
+        internal = tree['leaf_ids'][nodes] < 0
+
+    leaves = tree['leaf_ids'][nodes]
+    starts = tree['leaf_ptr'][leaves]
+    sizes = tree['leaf_ptr'][leaves + 1] - starts
+    cols = np.arange(np.max(sizes))
+    pos = np.minimum(starts[:, np.newaxis] + cols, tree['leaf_idx'].size - 1)
+    return np.where(cols < sizes[:, np.newaxis], tree['leaf_idx'][pos], -1)
@@ -4,7 +4,11 @@ nd segmentation (label map) utilities
 Contact: adalca@csail.mit.edu
 '''
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.ndimage
+
 from . import ndutils as nd
 
 
@@ -12,6 +16,12 @@ def seg2contour(seg, exclude_zero=True, contour_type='inner', thickness=1):
     '''
     transform nd segmentation (label maps) to contour maps
 
+    All the labels are processed at once, by comparing each voxel with its neighbours closer
+    than the thickness (shifted views of the volume, e.g. the face neighbours for thickness 1),
+    so the runtime does not depend on the number of labels. For large thickness, distance
+    transforms are instead computed within each label's bounding box, padded by the thickness.
+    Where the contours of several labels overlap, the largest label is kept.
+
     Parameters
     ----------
     seg : nd array
@@ -21,6 +31,8 @@ def seg2contour(seg, exclude_zero=True, contour_type='inner', thickness=1):
         default True
     contour_type : string
         where to draw contour voxels relative to label 'inner','outer', or 'both'
+    thickness : optional number
+        contour thickness, in voxels. default 1
 
     Output
     ------
@@ -32,26 +44,165 @@ def seg2contour(seg, exclude_zero=True, contour_type='inner', thickness=1):
     seg_overlap
     '''
 
-    # extract unique labels
-    labels = np.unique(seg)
-    if exclude_zero:
-        labels = np.delete(labels, np.where(labels == 0))
+    assert contour_type in ('inner', 'outer', 'both'), \
+        'contour_type should only be inner, outer or both'
 
-    # get the contour of each label
-    contour_map = seg * 0
-    for lab in labels:
+    # voxels closer than thr (see nd.bw2contour) are within the contour
+    thr = thickness + 0.01
+    offsets = _ball_offsets(seg.ndim, thr)
+    if len(offsets) <= _MAX_CONTOUR_OFFSETS:
+        return _seg2contour_shift(seg, exclude_zero, contour_type, offsets)
+    return _seg2contour_edt(seg, exclude_zero, contour_type, thr)
 
-        # extract binary label map for this label
-        label_map = seg == lab
 
-        # extract contour map for this label
-        thickness = thickness + 0.01
-        label_contour_map = nd.bw2contour(label_map, type=contour_type, thr=thickness)
+def seg2sdtrf(seg, labels=None, sampling=None, max_distance=None, dtype='float32',
+              nb_workers=1, exclude_zero=True):
+    '''
+    signed distance transforms of the labels of a nd segmentation (label map)
 
-        # assign contour to this label
-        contour_map[label_contour_map] = lab
+    Each label is transformed as in nd.bw2sdtrf (negative inside the label), directly into its
+    channel of a preallocated output. If max_distance is given, each label is only processed
+    within its bounding box padded by max_distance, so that the cost of a label depends on its
+    size rather than the size of the volume.
 
-    return contour_map
+    Parameters
+    ----------
+    seg : nd array
+        volume of labels/segmentations
+    labels : optional list
+        labels to transform. default: all the labels in seg (np.unique(seg)), see exclude_zero
+    sampling : optional float or sequence of floats
+        voxel spacing along each dimension. default 1
+    max_distance : optional float
+        distances are clipped to +/- max_distance. default None (no clipping)
+    dtype : optional numpy dtype
+        output type. default 'float32'
+    nb_workers : optional int
+        number of threads processing labels in parallel (the distance transforms release the
+        GIL). default 1
+    exclude_zero : optional logical
+        whether to exclude the zero label from the default labels. Explicitly given labels are
+        always transformed.
+        default True
+
+    Output
+    ------
+    sdtrf : nd array
+        [*seg.shape, L] signed distance maps, one per label. Labels absent from seg are
+        max_distance (or inf) everywhere.
+
+    See Also
+    --------
+    nd.bw2sdtrf, seg2contour
+    '''
+
+    seg_labels, seg_idx, boxes = _label_boxes(seg)
+    if labels is None:
+        labels = seg_labels[seg_labels != 0] if exclude_zero else seg_labels
+    labels = np.asarray(labels).ravel()
+    # far from every label, and absent labels, are max_distance (or inf) everywhere
+    sdtrf = np.full([*seg.shape, len(labels)], np.inf if max_distance is None else max_distance,
+                    dtype)
+
+    # index (into seg_labels) and bounding box of each requested label
+    label_idx = np.searchsorted(seg_labels, labels)
+    present = np.logical_and(label_idx < len(seg_labels),
+                             seg_labels[np.minimum(label_idx, len(seg_labels) - 1)] == labels)
+
+    def label_sdtrf(i):
+        out = sdtrf[..., i]
+        if not present[i]:
+            return
+        if max_distance is None:
+            nd.bw2sdtrf(seg_idx == label_idx[i], sampling, out=out)
+            return
+
+        spacing = np.broadcast_to(1.0 if sampling is None else sampling, [seg.ndim])
+        pad = np.ceil(max_distance / spacing).astype(int) + 1
+        crop = tuple(slice(max(0, f.start - p), min(s, f.stop + p))
+                     for f, p, s in zip(boxes[label_idx[i]], pad, seg.shape))
+        nd.bw2sdtrf(seg_idx[crop] == label_idx[i], sampling, max_distance, out=out[crop])
+
+    if nb_workers == 1:
+        for i in range(len(labels)):
+            label_sdtrf(i)
+    else:
+        with ThreadPoolExecutor(nb_workers) as executor:
+            list(executor.map(label_sdtrf, range(len(labels))))
+    return sdtrf
+
+
+def seg_regionprops(seg, vol=None, exclude_zero=True):
+    '''
+    statistics of every label of a nd segmentation (label map)
+
+    All the labels are processed together with bincount accumulations: one per axis, over the
+    (label, coordinate) pairs, gives the bounding boxes and centroids, and one over the label
+    boundaries gives the surface counts.
+
+    Parameters
+    ----------
+    seg : nd array
+        volume of labels/segmentations
+    vol : optional nd array
+        intensity image of the size of seg, for the mean intensity of each label
+    exclude_zero : optional logical
+        whether to exclude the zero label.
+        default True
+
+    Output
+    ------
+    props : structured array
+        one entry per label (in increasing order) with fields
+        label, count (number of voxels), bbox ([xstart ystart ... xend yend ...] as in
+        nd.boundingbox), centroid, mean_intensity (nan if vol is not given), and surface (number
+        of voxels with a face neighbour of another label, i.e. the 'inner' contour of
+        seg2contour)
+
+    See Also
+    --------
+    seg2contour, nd.boundingbox, nd.centroid
+    '''
+
+    labels, seg_idx = np.unique(seg, return_inverse=True)
+    seg_idx = np.reshape(seg_idx, seg.shape)
+    nb_labels, nb_dims = len(labels), seg.ndim
+    flat_idx = seg_idx.ravel()
+    props = np.zeros(nb_labels, dtype=[('label', seg.dtype), ('count', np.int64),
+                                       ('bbox', np.int64, (2 * nb_dims, )),
+                                       ('centroid', np.float64, (nb_dims, )),
+                                       ('mean_intensity', np.float64),
+                                       ('surface', np.int64)])
+    props['label'] = labels
+    props['count'] = np.bincount(flat_idx, minlength=nb_labels)
+
+    # histogram of each label along each axis, from the (label, coordinate) pairs
+    grid = nd.volsize2ndgrid(seg.shape, sparse=True)
+    pair_idx = np.empty(seg.shape, np.intp)
+    for d in range(nb_dims):
+        np.multiply(seg_idx, seg.shape[d], out=pair_idx)
+        pair_idx += grid[d]
+        hist = np.bincount(pair_idx.ravel(), minlength=nb_labels * seg.shape[d])
+        hist = np.reshape(hist, [nb_labels, seg.shape[d]])
+
+        props['centroid'][:, d] = np.dot(hist, np.arange(seg.shape[d])) / props['count']
+        props['bbox'][:, d] = np.argmax(hist > 0, 1)
+        props['bbox'][:, nb_dims + d] = seg.shape[d] - 1 - np.argmax(hist[:, ::-1] > 0, 1)
+
+    if vol is None:
+        props['mean_intensity'] = np.nan
+    else:
+        assert vol.shape == seg.shape, 'vol and seg should have the same shape'
+        props['mean_intensity'] = \
+            np.bincount(flat_idx, weights=np.ravel(vol), minlength=nb_labels) / props['count']
+
+    # voxels next to another label, with every label (including zero) shifted to be positive
+    surface = seg2contour(seg_idx + 1, contour_type='inner') > 0
+    props['surface'] = np.bincount(flat_idx[surface.ravel()], minlength=nb_labels)
+
+    if exclude_zero:
+        props = props[labels != 0]
+    return props
 
 
 def seg_overlap(vol, seg, do_contour=True, do_rgb=True, cmap=None, thickness=1.0):
@@ -119,3 +270,96 @@ def seg_overlay(vol, seg, do_rgb=True, seg_wt=0.5, cmap=None):
         olap = seg * seg_wt + vol * (1 - seg_wt)
 
     return olap
+
+
+# maximum number of neighbour offsets for which seg2contour compares shifted volumes
+_MAX_CONTOUR_OFFSETS = 256
+
+
+def _ball_offsets(nb_dims, thr):
+    '''
+    [M x nb_dims] non-zero integer offsets with a norm smaller than thr
+    '''
+
+    pad = int(np.ceil(thr))
+    grid = np.reshape(np.indices([2 * pad + 1] * nb_dims) - pad, [nb_dims, -1]).transpose()
+    norm = np.sqrt(np.sum(grid ** 2, 1))
+    return grid[np.logical_and(norm > 0, norm < thr)]
+
+
+def _seg2contour_shift(seg, exclude_zero, contour_type, offsets):
+    '''
+    contours of all labels, by comparing every voxel with its neighbours at the given offsets
+    '''
+
+    inner = np.zeros(seg.shape, bool)       # voxels near a different label
+    outer = np.zeros(seg.shape, seg.dtype)  # largest (valid) different label nearby
+    has_outer = np.zeros(seg.shape, bool)
+    for offset in offsets:
+        if np.any(np.abs(offset) >= np.array(seg.shape)):
+            continue
+        sl_dst = tuple(np.s_[-f:] if f < 0 else np.s_[:s - f] for f, s in zip(offset, seg.shape))
+        sl_src = tuple(np.s_[:s + f] if f < 0 else np.s_[f:] for f, s in zip(offset, seg.shape))
+        own, nbr = seg[sl_dst], seg[sl_src]
+
+        diff = own != nbr
+        inner[sl_dst] |= diff
+        if contour_type != 'inner':
+            valid = np.logical_and(diff, nbr != 0) if exclude_zero else diff
+            update = np.logical_and(valid, np.logical_or(~has_outer[sl_dst],
+                                                         nbr > outer[sl_dst]))
+            outer[sl_dst][update] = nbr[update]
+            has_outer[sl_dst] |= valid
+
+    contour_map = np.zeros(seg.shape, seg.dtype)
+    if contour_type != 'outer':
+        if exclude_zero:
+            inner &= seg != 0
+        contour_map[inner] = seg[inner]
+    if contour_type != 'inner':
+        update = has_outer if contour_type == 'outer' else \
+            np.logical_and(has_outer, np.logical_or(~inner, outer > contour_map))
+        contour_map[update] = outer[update]
+    return contour_map
+
+
+def _seg2contour_edt(seg, exclude_zero, contour_type, thr):
+    '''
+    contours of all labels closer than thr to the label surface, computing the distance
+    transforms of each label only within its bounding box, padded by thr
+    '''
+
+    labels, seg_idx, boxes = _label_boxes(seg)
+    pad = int(np.ceil(thr))
+
+    # labels in increasing order, so that larger labels overwrite smaller ones
+    contour_map = np.zeros(seg.shape, seg.dtype)
+    for idx, (lab, box) in enumerate(zip(labels, boxes)):
+        if exclude_zero and lab == 0:
+            continue
+        crop = tuple(slice(max(0, f.start - pad), min(s, f.stop + pad))
+                     for f, s in zip(box, seg.shape))
+        label_map = seg_idx[crop] == idx
+
+        label_contour_map = np.zeros(label_map.shape, bool)
+        if contour_type != 'outer':
+            negdst = scipy.ndimage.distance_transform_edt(label_map)
+            label_contour_map |= np.logical_and(label_map, negdst < thr)
+        if contour_type != 'inner':
+            posdst = scipy.ndimage.distance_transform_edt(~label_map)
+            label_contour_map |= np.logical_and(~label_map, posdst < thr)
+        contour_map[crop][label_contour_map] = lab
+
+    return contour_map
+
+
+def _label_boxes(seg):
+    '''
+    the (sorted) labels of seg, the index of the label of every voxel, and the bounding box
+    (tuple of slices) of every label
+    '''
+
+    labels, seg_idx = np.unique(seg, return_inverse=True)
+    seg_idx = np.reshape(seg_idx, seg.shape)
+    boxes = scipy.ndimage.find_objects(seg_idx + 1)
+    return (labels, seg_idx, boxes)